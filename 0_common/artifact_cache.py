@@ -0,0 +1,152 @@
+'''Local cache of the DataFrames read by the fetch tasks, stored as parquet.
+
+An artifact is keyed by its source (URL or local file) and a content hash: the SHA-256 of a local
+file, or the ETag / Last-Modified / Content-Length of a URL, so a changed source is read again.
+Sources without any of them are keyed by their URL alone and expire after MAX_AGE, like the
+task_input_hash caching it replaces. The options the source is read with (separator, dtypes, ...)
+are part of the key as well, so a reader with other options does not get the same DataFrame.
+
+Artifacts are written as parquet files and read back memory-mapped on a hit. The least recently
+used ones are evicted once the cache is over CACHE_MAX_BYTES. The index is a SQLite file in the
+cache folder, shared by all the flows of the repo on this machine (env FLOW_CACHE_DIR, default
+~/.cache/dezoomcamp/artifacts; env FLOW_CACHE_MAX_MB, default 10 GB).
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+from contextlib import closing
+from datetime import timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CACHE_DIR = os.environ.get("FLOW_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "dezoomcamp", "artifacts"))
+CACHE_MAX_BYTES = int(os.environ.get("FLOW_CACHE_MAX_MB", 10 * 1024)) * 2**20
+MAX_AGE = timedelta(days=1)
+
+def content_hash(source) -> str:
+    '''Content hash of a local file or URL, None when the source does not tell'''
+    if not f"{source}".startswith(('http://', 'https://')):
+        digest = hashlib.sha256()
+        with open(source, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(2**20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(f"{source}", method='HEAD'), timeout=30) as response:
+            validators = [response.headers.get(name) for name in ['ETag', 'Last-Modified', 'Content-Length']]
+    except OSError:
+        return None
+    if not any(validators):
+        return None
+    return hashlib.sha256('|'.join(f"{value}" for value in validators).encode()).hexdigest()
+
+class ArtifactCache:
+    def __init__(self, folder: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES, max_age: timedelta = MAX_AGE):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._created = False
+
+    def _connect(self):
+        # A short-lived connection per call, so the cache can be used from parallel task threads
+        if not self._created:
+            # Created on first use, not when the flows import the module
+            os.makedirs(self.folder, exist_ok=True)
+            with closing(sqlite3.connect(os.path.join(self.folder, 'index.sqlite'), timeout=30)) as con, con:
+                con.execute("CREATE TABLE IF NOT EXISTS artifacts (key TEXT PRIMARY KEY, source TEXT, content_hash TEXT, "
+                            "path TEXT, size INTEGER, rows INTEGER, created_at REAL, last_access REAL)")
+            self._created = True
+        con = sqlite3.connect(os.path.join(self.folder, 'index.sqlite'), timeout=30)
+        con.row_factory = sqlite3.Row
+        return closing(con)
+
+    @staticmethod
+    def key(source, content_hash: str = None, read_options: dict = None) -> str:
+        key = f"{source}|{content_hash}"
+        if read_options:
+            # Types (numpy dtypes, str) are keyed by their name
+            key += f"|{json.dumps(read_options, sort_keys=True, default=str)}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, source, content_hash: str = None, read_options: dict = None) -> pa.Table:
+        '''Cached table of a source, content hash and read options, None on a miss'''
+        key = self.key(source, content_hash, read_options)
+        with self._connect() as con, con:
+            row = con.execute("SELECT * FROM artifacts WHERE key = ?", (key,)).fetchone()
+            expired = row is not None and content_hash is None and time.time() - row['created_at'] > self.max_age.total_seconds()
+            if row is None or expired or not os.path.exists(row['path']):
+                self._count(hit=False)
+                return None
+            con.execute("UPDATE artifacts SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._count(hit=True)
+        return pq.read_table(row['path'], memory_map=True)
+
+    def put(self, source, content_hash: str, table: pa.Table, read_options: dict = None) -> None:
+        '''Store the table of a source, content hash and read options, then evict down to the size limit'''
+        key = self.key(source, content_hash, read_options)
+        path = os.path.join(self.folder, f"{key}.parquet")
+        pq.write_table(table, f"{path}.part")
+        os.replace(f"{path}.part", path)
+        now = time.time()
+        with self._connect() as con, con:
+            con.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, f"{source}", content_hash, path, os.path.getsize(path), table.num_rows, now, now))
+        self.evict()
+
+    def evict(self) -> None:
+        '''Remove the least recently used artifacts until the cache fits in max_bytes'''
+        with self._connect() as con, con:
+            rows = con.execute("SELECT key, path, size FROM artifacts ORDER BY last_access DESC").fetchall()
+            total = 0
+            for row in rows:
+                total += row['size']
+                if total > self.max_bytes:
+                    con.execute("DELETE FROM artifacts WHERE key = ?", (row['key'],))
+                    if os.path.exists(row['path']):
+                        os.remove(row['path'])
+                    with self._lock:
+                        self.evictions += 1
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        '''Hits, misses and evictions of this process, and the size of the cache'''
+        with self._connect() as con:
+            count, size = con.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'artifacts': count, 'size_mb': round(size / 2**20, 1)}
+
+    def fetch(self, source, read, read_options: dict = None):
+        '''DataFrame of a source from the cache, or from read() which is then cached.
+
+        read_options are the options read() reads the source with, part of the cache key.
+        '''
+        digest = content_hash(source)
+        table = self.get(source, digest, read_options)
+        if table is not None:
+            df = table.to_pandas()
+        else:
+            df = read()
+            # The cache only saves time: a DataFrame it cannot store (or a full disk) does not fail the fetch
+            try:
+                self.put(source, digest, pa.Table.from_pandas(df, preserve_index=False), read_options)
+            except Exception as e:
+                print(f"artifact cache could not store {source}: {e!r}")
+        print(f"artifact cache {'hit' if table is not None else 'miss'} for {source}: {self.stats()}")
+        return df
+
+CACHE = ArtifactCache()
@@ -0,0 +1,49 @@
+'''The steps the taxi flows share to load a month from GCS into BigQuery with a parquet load job:
+download the parquet file of the month to a local (temporary) folder, then rewrite it row group by
+row group into a file BigQuery loads as is.
+'''
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from prefect import task
+from prefect_gcp.cloud_storage import GcsBucket
+
+from instrumentation import instrumented
+
+@task(retries=3)
+@instrumented()
+def download_from_gcs(color: str, year: int, month: int, local_folder: str) -> Path:
+    """Download the trip data parquet file of a month from GCS to a local (temporary) folder"""
+    gcs_path = f"{color}_tripdata_{year}-{month:02}.parquet"
+    local_path = Path(local_folder) / gcs_path
+    GcsBucket.load("dezoomcamp-gcs").download_object_to_path(from_path=gcs_path, to_path=local_path)
+    return local_path
+
+def rewrite_parquet(path: Path, save_to: Path, convert=None) -> int:
+    """Rewrite a parquet file one row group at a time, with microsecond timestamps, and return the rows.
+
+    BigQuery loads and partitions on microsecond timestamps only. convert, if given, maps every
+    row group (a pyarrow Table) to the one written, e.g. to fill or cast columns.
+    """
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    if convert is not None:
+        schema = convert(schema.empty_table()).schema
+    rows = 0
+    with pq.ParquetWriter(save_to, schema, coerce_timestamps='us', allow_truncated_timestamps=True) as writer:
+        for i in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(i)
+            if convert is not None:
+                table = convert(table)
+            writer.write_table(table)
+            rows += table.num_rows
+    return rows
+
+def integer_columns(table: pa.Table, columns: list[str]) -> pa.Table:
+    """Cast the floating point columns among columns to (nullable) int64, as pandas writes nullable IDs as floats"""
+    for col in columns:
+        index = table.schema.get_field_index(col)
+        if index >= 0 and pa.types.is_floating(table.schema.field(index).type):
+            table = table.set_column(index, col, table[col].cast(pa.int64()))
+    return table
@@ -0,0 +1,120 @@
+'''Timing and size metrics for the tasks of the flows, shared by all the chapters.
+
+Decorate a task function (below @task) with @instrumented(), or wrap a block with `with measure("name") as record:`.
+Every call produces one record with the wall time, rows in and out, bytes read and written and the peak memory.
+Rows in are taken from the first DataFrame/Arrow table argument, rows out from a returned one (or a returned
+row count), bytes read from the Path arguments (or the arguments named in read_from) and bytes written from a
+returned Path. A block can set them on its record. The memory fields are process-wide: tasks running in
+parallel threads of the same process all count in them.
+
+The records are logged as JSON through the Prefect run logger (print outside of a run) and appended as JSON
+lines to the metrics file, METRICS_PATH (env FLOW_METRICS_PATH, default metrics.jsonl next to this module).
+The expensive debug output of the flows (df.head(), df.describe(), ...) only runs with FLOW_DEBUG=1.
+
+The flows put this folder (0_common) on sys.path before importing it.
+'''
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+DEBUG = os.environ.get("FLOW_DEBUG", "0") == "1"
+METRICS_PATH = os.environ.get("FLOW_METRICS_PATH",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics.jsonl"))
+
+_metrics_lock = threading.Lock()
+
+def peak_rss_mb() -> float:
+    '''Peak resident memory of this process in MB'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def row_count(value) -> int:
+    '''Rows of a pandas DataFrame or an Arrow table, None for anything else'''
+    if hasattr(value, 'num_rows'):
+        return value.num_rows
+    if hasattr(value, 'shape') and hasattr(value, 'columns'):
+        return value.shape[0]
+    return None
+
+def file_size(value) -> int:
+    '''Size of a local file or of the files in a local folder given as a Path, None for anything else'''
+    if not isinstance(value, Path):
+        return None
+    if value.is_file():
+        return value.stat().st_size
+    if value.is_dir():
+        return sum(file.stat().st_size for file in value.rglob('*') if file.is_file())
+    return None
+
+def emit(record: dict) -> None:
+    '''Log a metrics record and append it to the metrics file'''
+    line = json.dumps(record, default=str)
+    try:
+        from prefect import get_run_logger
+        get_run_logger().info(f"metrics {line}")
+    except Exception:
+        print(f"metrics {line}")
+    with _metrics_lock:
+        with open(METRICS_PATH, 'a') as fd:
+            fd.write(line + '\n')
+
+@contextmanager
+def measure(name: str, **fields):
+    '''Measure a block; the yielded record can be completed with rows_in, rows_out, bytes_read and bytes_written'''
+    record = {'name': name, 'started_at': datetime.now(timezone.utc).isoformat(),
+              'rows_in': None, 'rows_out': None, 'bytes_read': None, 'bytes_written': None, **fields}
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+        record['status'] = 'ok'
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        record['seconds'] = round(seconds, 3)
+        if record['rows_out'] is not None:
+            record['rows_per_s'] = round(record['rows_out'] / max(seconds, 1e-9))
+        # Process-wide, not per task: with parallel tasks this includes the memory of the others
+        record['process_peak_rss_mb'] = round(peak_rss_mb())
+        record['process_peak_rss_growth_mb'] = round(record['process_peak_rss_mb'] - rss_before)
+        emit(record)
+
+def instrumented(name: str = None, read_from: list[str] = None):
+    '''Decorator that measures every call of a function (see measure).
+
+    read_from names the arguments (str or Path) whose files are the bytes read; by default the Path arguments.
+    '''
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            values = list(args) + list(kwargs.values())
+            if read_from is None:
+                sources = values
+            else:
+                arguments = signature.bind_partial(*args, **kwargs).arguments
+                sources = [Path(value) if isinstance(value, str) else value
+                           for value in (arguments.get(arg) for arg in read_from)]
+            with measure(name or fn.__name__) as record:
+                record['rows_in'] = next((rows for rows in map(row_count, values) if rows is not None), None)
+                sizes = [size for size in map(file_size, sources) if size is not None]
+                record['bytes_read'] = sum(sizes) if sizes else None
+                result = fn(*args, **kwargs)
+                # The tasks that return a number return the number of rows they processed
+                record['rows_out'] = result if isinstance(result, int) and not isinstance(result, bool) else row_count(result)
+                record['bytes_written'] = file_size(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,191 @@
+"""Streaming conversion of the NYC taxi .csv.gz files to parquet, with bounded memory.
+
+The file is decompressed and parsed block by block by the PyArrow CSV reader, with the column
+types of its color and the datetimes parsed at read time, and written out row group by row group.
+Only one row group is in memory at a time, whatever the size of the month. The parquet is gzip
+compressed, like the files write_local writes from a DataFrame.
+
+The source is a URL or a local file, so the conversion can be benchmarked without network:
+    python 0_common/streaming_fetch.py --color yellow --source yellow_tripdata_2019-02.csv.gz
+    python 0_common/streaming_fetch.py --color yellow --synthetic_rows 7000000 --compare
+"""
+import gzip
+import os
+import tempfile
+import time
+import urllib.request
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from instrumentation import peak_rss_mb
+
+TIMESTAMP = pa.timestamp('us')
+# The nullable codes are floats, as pandas reads them
+TAXI_SCHEMAS = {
+    "green": pa.schema([('VendorID', pa.float64()),
+                        ('lpep_pickup_datetime', TIMESTAMP),
+                        ('lpep_dropoff_datetime', TIMESTAMP),
+                        ('store_and_fwd_flag', pa.string()),
+                        ('RatecodeID', pa.float64()),
+                        ('PULocationID', pa.int64()),
+                        ('DOLocationID', pa.int64()),
+                        ('passenger_count', pa.float64()),
+                        ('trip_distance', pa.float64()),
+                        ('fare_amount', pa.float64()),
+                        ('extra', pa.float64()),
+                        ('mta_tax', pa.float64()),
+                        ('tip_amount', pa.float64()),
+                        ('tolls_amount', pa.float64()),
+                        ('ehail_fee', pa.float64()),
+                        ('improvement_surcharge', pa.float64()),
+                        ('total_amount', pa.float64()),
+                        ('payment_type', pa.float64()),
+                        ('trip_type', pa.float64()),
+                        ('congestion_surcharge', pa.float64())]),
+    "yellow": pa.schema([('VendorID', pa.float64()),
+                         ('tpep_pickup_datetime', TIMESTAMP),
+                         ('tpep_dropoff_datetime', TIMESTAMP),
+                         ('passenger_count', pa.float64()),
+                         ('trip_distance', pa.float64()),
+                         ('RatecodeID', pa.float64()),
+                         ('store_and_fwd_flag', pa.string()),
+                         ('PULocationID', pa.int64()),
+                         ('DOLocationID', pa.int64()),
+                         ('payment_type', pa.float64()),
+                         ('fare_amount', pa.float64()),
+                         ('extra', pa.float64()),
+                         ('mta_tax', pa.float64()),
+                         ('tip_amount', pa.float64()),
+                         ('tolls_amount', pa.float64()),
+                         ('improvement_surcharge', pa.float64()),
+                         ('total_amount', pa.float64()),
+                         ('congestion_surcharge', pa.float64())]),
+    "fhv": pa.schema([('dispatching_base_num', pa.string()),
+                      ('pickup_datetime', TIMESTAMP),
+                      ('dropOff_datetime', TIMESTAMP),
+                      ('PUlocationID', pa.float64()),
+                      ('DOlocationID', pa.float64()),
+                      ('SR_Flag', pa.float64()),
+                      ('Affiliated_base_number', pa.string())]),
+}
+# Larger blocks are not faster (decompression is the bottleneck) and let the memory pool grow with the file
+BLOCK_SIZE = 4 * 2**20
+ROW_GROUP_SIZE = 500000
+
+def open_source(source: str, stack: ExitStack):
+    """Input stream of a URL or local file, gunzipped on the fly when it ends with .gz"""
+    compression = 'gzip' if f"{source}".endswith('.gz') else None
+    if f"{source}".startswith(('http://', 'https://')):
+        response = stack.enter_context(urllib.request.urlopen(source))
+        stream = pa.PythonFile(response, mode='r')
+        return pa.CompressedInputStream(stream, compression) if compression else stream
+    return stack.enter_context(pa.input_stream(f"{source}", compression=compression))
+
+def stream_csv_to_parquet(source: str, path, color: str, block_size: int = BLOCK_SIZE,
+                          row_group_size: int = ROW_GROUP_SIZE, compression: str = "gzip") -> int:
+    """Convert a taxi CSV (URL or local file) to parquet one row group at a time and return the rows.
+
+    Columns of the color schema get its types, the datetimes are parsed while reading; other
+    columns are inferred on the first block. The blocks are buffered into row groups of exactly
+    row_group_size rows, only the last one is smaller.
+    """
+    schema = TAXI_SCHEMAS[color]
+    convert_options = pv.ConvertOptions(column_types=dict(zip(schema.names, schema.types)),
+                                        timestamp_parsers=["%Y-%m-%d %H:%M:%S"])
+    rows = 0
+    with ExitStack() as stack:
+        reader = pv.open_csv(open_source(source, stack), read_options=pv.ReadOptions(block_size=block_size),
+                             convert_options=convert_options)
+        writer = stack.enter_context(pq.ParquetWriter(f"{path}.part", reader.schema, compression=compression))
+        batches, buffered = [], 0
+        for batch in reader:
+            batches.append(batch)
+            buffered += batch.num_rows
+            if buffered >= row_group_size:
+                table = pa.Table.from_batches(batches)
+                full = buffered - buffered % row_group_size
+                writer.write_table(table.slice(0, full), row_group_size=row_group_size)
+                rows += full
+                # The rows past the last full row group start the next one
+                batches = table.slice(full).to_batches()
+                buffered -= full
+        if buffered:
+            writer.write_table(pa.Table.from_batches(batches, reader.schema), row_group_size=row_group_size)
+            rows += buffered
+    os.replace(f"{path}.part", path)
+    return rows
+
+def pandas_csv_to_parquet(source: str, path, color: str) -> int:
+    """The in-memory conversion of the flows, for comparison"""
+    import pandas as pd
+    df = pd.read_csv(source)
+    for col in TAXI_SCHEMAS[color].names:
+        if col.endswith('_datetime') and col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    df.to_parquet(path, compression="gzip")
+    return len(df)
+
+def synthetic_csv(path, color: str, rows: int, seed: int = 0) -> None:
+    """Write a gzipped CSV of random rows with the columns of a color"""
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    schema = TAXI_SCHEMAS[color]
+    with gzip.open(path, 'wt', compresslevel=1) as fd:
+        for start in range(0, rows, 1000000):
+            n = min(1000000, rows - start)
+            columns = {}
+            for field in schema:
+                if field.type == TIMESTAMP:
+                    seconds = rng.integers(1548979200, 1551398400, n)
+                    columns[field.name] = pd.to_datetime(seconds, unit='s').strftime("%Y-%m-%d %H:%M:%S")
+                elif field.type == pa.string():
+                    columns[field.name] = rng.choice(['N', 'Y', 'B00254'], n)
+                elif field.type == pa.int64():
+                    columns[field.name] = rng.integers(1, 266, n)
+                else:
+                    values = rng.integers(0, 100, n).astype(float)
+                    values[rng.random(n) < 0.01] = np.nan
+                    columns[field.name] = values
+            pd.DataFrame(columns).to_csv(fd, index=False, header=start == 0)
+
+def run(convert, source, color) -> dict:
+    """Convert in this process and return the time, rows and peak memory"""
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "out.parquet"
+        baseline = peak_rss_mb()
+        start = time.perf_counter()
+        rows = convert(source, path, color)
+        seconds = time.perf_counter() - start
+        return {"method": convert.__name__, "rows": rows, "seconds": round(seconds, 2),
+                "rows_per_s": round(rows / max(seconds, 1e-9)), "parquet_mb": round(path.stat().st_size / 2**20, 1),
+                "peak_rss_mb": round(peak_rss_mb()), "baseline_rss_mb": round(baseline)}
+
+if __name__ == "__main__":
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    parser = ArgumentParser()
+    parser.add_argument('--color', choices=TAXI_SCHEMAS, default="yellow")
+    parser.add_argument('--source', default=None, help="URL or local .csv/.csv.gz file")
+    parser.add_argument('--synthetic_rows', type=int, default=1000000, help="rows of a generated file, without --source")
+    parser.add_argument('--compare', action='store_true', help="also run the pandas conversion")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        source = args.source
+        if source is None:
+            source = os.path.join(folder, f"{args.color}_synthetic.csv.gz")
+            # Generate in a worker as well: on Linux a new process inherits the peak memory of its parent
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                executor.submit(synthetic_csv, source, args.color, args.synthetic_rows).result()
+        methods = [stream_csv_to_parquet] + ([pandas_csv_to_parquet] if args.compare else [])
+        for convert in methods:
+            # Every conversion in a fresh process, so its peak memory is its own
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                print(executor.submit(run, convert, source, args.color).result())
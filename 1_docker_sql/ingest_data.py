@@ -0,0 +1,253 @@
+'''Bulk load taxi CSV files into Postgres with COPY FROM STDIN.
+
+Replaces the chunked to_sql loop of postgres_ingestion.ipynb. Every CSV file (local path or URL, optionally
+gzipped) is parsed in chunks while a bounded pool of --workers connections COPY the parsed chunks, so
+parsing and loading overlap; with a range of months, --max_files files are fetched and parsed at the same
+time. Every chunk is committed on its own and reported with its throughput.
+
+Tables with a *pickup_datetime column are partitioned by month of pickup: the chunks are split by month and
+copied straight into the monthly partitions (e.g. green_taxi_data_2019_01), which are created on the fly.
+The indexes are only created once all the files are loaded.
+
+One file, against the docker-compose database:
+    python ingest_data.py --user root --password root --host localhost --port 5432 --db green_taxi \
+        --table_name green_taxi_data --url green_tripdata_2019-01.csv
+A range of months, into <color>_taxi_data:
+    python ingest_data.py --user root --password root --db green_taxi --colors green --year 2019 --months 1 2 3
+'''
+import argparse
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+DATASET_URL = "https://github.com/DataTalksClub/nyc-tlc-data/releases/download/{color}/{color}_tripdata_{year}-{month:02}.csv.gz"
+PARTITION_COLUMN_SUFFIX = 'pickup_datetime'
+# Indexed after the load, when present (matched on the end of the column name)
+INDEX_COLUMNS = ['pickup_datetime', 'PULocationID', 'DOLocationID']
+
+def database_url(user: str, password: str, host: str, port: int, db: str) -> str:
+    return f'postgresql://{user}:{password}@{host}:{port}/{db}'
+
+def read_chunks(url: str, chunksize: int):
+    '''Parse the CSV file in chunks, with the *_datetime columns as timestamps'''
+    for df in pd.read_csv(url, chunksize=chunksize):
+        for column in df.columns:
+            if column.lower().endswith('_datetime'):
+                df[column] = pd.to_datetime(df[column])
+        yield df
+
+def partition_column(columns: list[str]) -> str:
+    '''Column the table is partitioned on by month, None if it has no pickup time'''
+    return next((column for column in columns if column.lower().endswith(PARTITION_COLUMN_SUFFIX)), None)
+
+def serialize(df: pd.DataFrame, integer_columns: list[str]) -> str:
+    '''CSV payload of a chunk for COPY; missing values become empty fields, which COPY loads as NULL'''
+    # A chunk with missing values in an integer column parses it as float, which BIGINT would reject
+    df = df.astype({column: 'Int64' for column in integer_columns})
+    return df.to_csv(index=False, header=False)
+
+class TableSetup:
+    '''Creates every table and monthly partition once, also when several files load into them concurrently'''
+    def __init__(self, engine, if_exists: str = 'replace', partitioned: bool = True):
+        self.engine = engine
+        self.if_exists = if_exists
+        self.partitioned = partitioned
+        self._tables = {}
+        self._partitions = set()
+        self._lock = threading.Lock()
+
+    def table(self, table_name: str, df: pd.DataFrame) -> dict:
+        '''Create the table from the columns of the first chunk; returns its integer and partition columns'''
+        with self._lock:
+            if table_name in self._tables:
+                return self._tables[table_name]
+            column = partition_column(df.columns) if self.partitioned else None
+            with self.engine.begin() as con:
+                exists = self.engine.dialect.has_table(con, table_name)
+                if exists and self.if_exists == 'fail':
+                    raise ValueError(f"Table {table_name} already exists")
+                if exists and self.if_exists == 'replace':
+                    con.execute(text(f'DROP TABLE "{table_name}" CASCADE'))
+                if not exists or self.if_exists == 'replace':
+                    ddl = pd.io.sql.get_schema(df, table_name, con=con).rstrip().rstrip(';')
+                    if column is not None:
+                        ddl += f' PARTITION BY RANGE ("{column}")'
+                    con.execute(text(ddl))
+                    if column is not None:
+                        # Rows without a pickup time
+                        con.execute(text(f'CREATE TABLE "{table_name}_default" PARTITION OF "{table_name}" DEFAULT'))
+                else:
+                    # Appending: only partition if the existing table is partitioned
+                    partitioned = con.execute(text("SELECT count(*) FROM pg_partitioned_table WHERE partrelid = CAST(:name AS regclass)"),
+                                              {'name': f'"{table_name}"'}).scalar()
+                    column = column if partitioned else None
+            self._tables[table_name] = {
+                'integer_columns': [col for col in df.columns if pd.api.types.is_integer_dtype(df[col])],
+                'partition_column': column}
+            return self._tables[table_name]
+
+    def partition(self, table_name: str, month: pd.Period) -> str:
+        '''Create the partition of a month if needed and return its name'''
+        name = f"{table_name}_{month.year}_{month.month:02}"
+        with self._lock:
+            if name not in self._partitions:
+                start, end = month.start_time, (month + 1).start_time
+                with self.engine.begin() as con:
+                    # Attaching a partition scans the default partition, which only holds the rows without pickup time
+                    con.execute(text(f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table_name}" '
+                                     f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+                self._partitions.add(name)
+        return name
+
+    def create_indexes(self) -> None:
+        '''Create the deferred indexes of all the loaded tables and refresh their statistics'''
+        for table_name in self._tables:
+            start = time.perf_counter()
+            with self.engine.begin() as con:
+                columns = [row[0] for row in con.execute(text(
+                    "SELECT column_name FROM information_schema.columns WHERE table_name = :name"), {'name': table_name})]
+                for column in columns:
+                    if any(column.lower().endswith(suffix.lower()) for suffix in INDEX_COLUMNS):
+                        con.execute(text(f'CREATE INDEX IF NOT EXISTS "{table_name}_{column}_idx" ON "{table_name}" ("{column}")'))
+                con.execute(text(f'ANALYZE "{table_name}"'))
+            print(f"Indexed {table_name} in {time.perf_counter() - start:.1f}s")
+
+class CopyWorkers:
+    '''Bounded pool of threads that COPY chunk payloads, each thread with its own connection'''
+    def __init__(self, engine, workers: int):
+        self.engine = engine
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = self.engine.raw_connection()
+            with self._lock:
+                self._connections.append(self._local.connection)
+        return self._local.connection
+
+    def copy(self, label: str, target: str, columns: list[str], rows: int, payload: str, parse_seconds: float) -> int:
+        '''COPY one chunk into a table (or partition) and commit it'''
+        connection = self.connection()
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        start = time.perf_counter()
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(f'COPY "{target}" ({column_list}) FROM STDIN WITH (FORMAT csv)', io.StringIO(payload))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        seconds = time.perf_counter() - start
+        mb = len(payload) / 2**20
+        print(f"{label} -> {target}: {rows} rows, parsed in {parse_seconds:.2f}s, copied in {seconds:.2f}s "
+              f"({rows / max(seconds, 1e-9):.0f} rows/s, {mb / max(seconds, 1e-9):.1f} MB/s)")
+        return rows
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for connection in self._connections:
+            connection.close()
+
+def ingest_file(url: str, table_name: str, setup: TableSetup, copiers: CopyWorkers, chunksize: int = 100000) -> int:
+    '''Load one CSV file, parsing its next chunks while the previous ones are copied'''
+    start = time.perf_counter()
+    # At most two chunks per connection are parsed ahead, which bounds the memory in use
+    in_flight = threading.BoundedSemaphore(2 * copiers.workers)
+    futures = []
+
+    def copy(*args):
+        try:
+            return copiers.copy(*args)
+        finally:
+            in_flight.release()
+
+    parse_start = time.perf_counter()
+    for chunk, df in enumerate(read_chunks(url, chunksize)):
+        table = setup.table(table_name, df)
+        column = table['partition_column']
+        if column is None:
+            groups = [(table_name, df)]
+        else:
+            # Copy every month straight into its partition, the rows without pickup time into the table
+            months = df[column].dt.to_period('M')
+            groups = [(setup.partition(table_name, month), group) for month, group in df.groupby(months)]
+            if months.isna().any():
+                groups.append((table_name, df[months.isna()]))
+        payloads = [(target, len(group), serialize(group, table['integer_columns'])) for target, group in groups]
+        parse_seconds = time.perf_counter() - parse_start
+
+        for target, rows, payload in payloads:
+            in_flight.acquire()
+            failed = [future for future in futures if future.done() and future.exception() is not None]
+            if failed:
+                in_flight.release()
+                raise failed[0].exception()
+            futures.append(copiers.executor.submit(copy, f"{url} chunk {chunk}", target, list(df.columns), rows, payload, parse_seconds))
+        parse_start = time.perf_counter()
+
+    rows = sum(future.result() for future in futures)
+    seconds = time.perf_counter() - start
+    print(f"Loaded {rows} rows of {url} into {table_name} in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    return rows
+
+def ingest(sources: list[tuple], engine, chunksize: int = 100000, workers: int = 2, max_files: int = 2,
+           if_exists: str = 'replace', partitioned: bool = True) -> int:
+    '''Load (url, table_name) sources, max_files of them concurrently, then create the indexes'''
+    start = time.perf_counter()
+    setup = TableSetup(engine, if_exists, partitioned)
+    copiers = CopyWorkers(engine, workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_files)) as executor:
+            futures = [executor.submit(ingest_file, url, table_name, setup, copiers, chunksize) for url, table_name in sources]
+            rows = sum(future.result() for future in futures)
+    finally:
+        copiers.close()
+    setup.create_indexes()
+    seconds = time.perf_counter() - start
+    print(f"Loaded {rows} rows from {len(sources)} file(s) in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    return rows
+
+def sources_for(colors: list[str], year: int, months: list[int], table_name: str = None) -> list[tuple]:
+    '''(url, table) of every color and month, into <color>_taxi_data unless a table is given'''
+    return [(DATASET_URL.format(color=color, year=year, month=month), table_name or f"{color}_taxi_data")
+            for color in colors for month in months]
+
+def main(params):
+    # The pool is bounded: one connection per COPY worker and one for the table setup
+    engine = create_engine(database_url(params.user, params.password, params.host, params.port, params.db),
+                           pool_size=params.workers + 1, max_overflow=0)
+    if params.url:
+        if not params.table_name:
+            raise SystemExit("--table_name is required with --url")
+        sources = [(params.url, params.table_name)]
+    else:
+        sources = sources_for(params.colors, params.year, params.months, params.table_name)
+    ingest(sources, engine, params.chunksize, params.workers, params.max_files, params.if_exists,
+           partitioned=not params.no_partitions)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load CSV data into Postgres with COPY')
+    parser.add_argument('--user', required=True, help='user name for postgres')
+    parser.add_argument('--password', required=True, help='password for postgres')
+    parser.add_argument('--host', default='localhost', help='host for postgres')
+    parser.add_argument('--port', type=int, default=5432, help='port for postgres')
+    parser.add_argument('--db', required=True, help='database name for postgres')
+    parser.add_argument('--table_name', help='name of the table where the results will be written (default <color>_taxi_data)')
+    parser.add_argument('--url', help='path or url of a single csv file (may be gzipped)')
+    parser.add_argument('--colors', nargs='+', default=['green'], help='taxi colors to load without --url')
+    parser.add_argument('--year', type=int, default=2019, help='year to load without --url')
+    parser.add_argument('--months', nargs='+', type=int, default=[1], help='months to load without --url')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows per COPY')
+    parser.add_argument('--workers', type=int, default=2, help='size of the COPY connection pool')
+    parser.add_argument('--max_files', type=int, default=2, help='files fetched and parsed at the same time')
+    parser.add_argument('--if_exists', choices=['replace', 'append', 'fail'], default='replace')
+    parser.add_argument('--no_partitions', action='store_true', help='do not partition the tables by month of pickup')
+    main(parser.parse_args())
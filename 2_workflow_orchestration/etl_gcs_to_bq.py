@@ -1,18 +1,29 @@
 from pathlib import Path
 import pandas as pd
+import pyarrow.compute as pc
 from prefect import flow, task
 from prefect_gcp.cloud_storage import GcsBucket
-import os
-from prefect.tasks import task_input_hash
-from datetime import timedelta
+import time
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from prefect_gcp import GcpCredentials
+import sys
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(str(Path(__file__).resolve().parents[1] / "0_common"))
+from gcs_parquet import download_from_gcs, rewrite_parquet
+from instrumentation import DEBUG, instrumented
+
+PROJECT_ID = "dezoomcamp-green-taxi"
+DESTINATION_TABLE = "yellow_trips_data.rides"
 
 @task(retries=3)
-def extract_from_gcs(color:str, year:int, month: int) -> Path:
-    """Download trip data from GCS"""
+@instrumented()
+def extract_from_gcs(color:str, year:int, month: int, local_folder: str) -> Path:
+    """Download trip data from GCS to a local (temporary) folder"""
     gcs_path = f"{color}_tripdata_{year}-{month:02}.parquet"
     gcs_block = GcsBucket.load("dezoomcamp-gcs")
-    local_path = Path(f"/Users/dg/Downloads/dezoomcamp/data")
+    local_path = Path(local_folder)
     gcs_block.get_directory(
         from_path=gcs_path,
         local_path=local_path
@@ -21,44 +32,108 @@ def extract_from_gcs(color:str, year:int, month: int) -> Path:
     return Path(f"{local_path}/{gcs_path}")
 
 @task()
+@instrumented()
 def transform(path: Path) -> pd.DataFrame:
     """Data cleaning"""
     df = pd.read_parquet(path)
-    print(f"pre:missing passenger count: {df['passenger_count'].isna().sum()}")
+    if DEBUG:
+        print(f"pre:missing passenger count: {df['passenger_count'].isna().sum()}")
     df['passenger_count'].fillna(0, inplace=True)
-    print(f"post:missing passenger count: {df['passenger_count'].isna().sum()}")
+    if DEBUG:
+        print(f"post:missing passenger count: {df['passenger_count'].isna().sum()}")
     return df
 
 @task()
+@instrumented()
 def write_bq(df: pd.DataFrame) -> None:
     """Write DataFrame to BigQuery"""
 
     gcp_credentials_block = GcpCredentials.load("dezoomcamp-gcp-creds")
     df.to_gbq(
-        destination_table="yellow_trips_data.rides",
-        project_id="dezoomcamp-green-taxi",
+        destination_table=DESTINATION_TABLE,
+        project_id=PROJECT_ID,
         credentials=gcp_credentials_block.get_credentials_from_service_account(),
         chunksize=500000,
         if_exists="append"
     )
 
+@task()
+@instrumented()
+def transform_parquet(path: Path, save_to: Path) -> int:
+    """Data cleaning, one row group at a time: fill the missing passenger counts and write BigQuery compatible timestamps"""
+    def fill_passenger_count(table):
+        column = table.schema.get_field_index('passenger_count')
+        return table.set_column(column, 'passenger_count', pc.fill_null(table['passenger_count'], 0))
+    return rewrite_parquet(path, save_to, fill_passenger_count)
+
+@task(retries=3)
+@instrumented()
+def load_bq(path: Path) -> int:
+    """Append a parquet file to the BigQuery table with a load job and return the rows loaded"""
+    from google.cloud import bigquery
+    client = GcpCredentials.load("dezoomcamp-gcp-creds").get_bigquery_client(project=PROJECT_ID)
+    job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET,
+                                        write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+    with open(path, 'rb') as fd:
+        job = client.load_table_from_file(fd, f"{PROJECT_ID}.{DESTINATION_TABLE}", job_config=job_config)
+    return job.result().output_rows
+
+@flow(log_prints=True)
+def etl_gcs_to_bq_load_job(color:str, year:int, month:int) -> int:
+    """ETL flow of a month with a parquet load job; the local files only live in a temporary folder"""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as folder:
+        path = download_from_gcs(color, year, month, folder)
+        transformed = Path(folder) / f"clean_{path.name}"
+        transform_parquet(path, transformed)
+        # The downloaded file is not needed anymore
+        path.unlink()
+        rows = load_bq(transformed)
+    seconds = time.perf_counter() - start
+    print(f"{color} {year}-{month:02}: {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    return rows
+
 @flow()
 def etl_gcs_to_bq(color:str, year:int, month:int) -> int:
     """Main ETL flow to load data into BigQuery"""
 
-    path = extract_from_gcs(color, year, month)
-    df = transform(path)
+    with tempfile.TemporaryDirectory() as folder:
+        path = extract_from_gcs(color, year, month, folder)
+        df = transform(path)
     write_bq(df)
     return len(df)
 
 @flow(log_prints=True)
-def etl_gcs_to_bq_main(color:str, year:int, months: list[int]) -> None:
+def etl_gcs_to_bq_main(color:str, year:int, months: list[int], load_jobs: bool = False, max_workers: int = 1) -> None:
+    """Load every month into BigQuery
+
+    load_jobs loads the months with parquet load jobs (etl_gcs_to_bq_load_job) instead of
+    chunked to_gbq inserts; with max_workers > 1 that many months run at the same time.
+    """
+    monthly_flow = etl_gcs_to_bq_load_job if load_jobs else etl_gcs_to_bq
     total_lines_processed = 0
-    for month in months:
-        lines_processed = etl_gcs_to_bq(color=color, year=year, month=month)
-        total_lines_processed += lines_processed
+    start = time.perf_counter()
+    if max_workers <= 1:
+        for month in months:
+            lines_processed = monthly_flow(color=color, year=year, month=month)
+            total_lines_processed += lines_processed
+    else:
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Run every month in a copy of this flow's context, so it is tracked as a subflow of this run
+            futures = {executor.submit(contextvars.copy_context().run, monthly_flow, color, year, month): month
+                       for month in months}
+            for future in as_completed(futures):
+                try:
+                    total_lines_processed += future.result()
+                except Exception as e:
+                    print(f"Month {year}-{futures[future]:02} failed: {e}")
+                    failed.append(futures[future])
+        if failed:
+            raise RuntimeError(f"{len(failed)} month(s) failed: {sorted(failed)}")
 
-    print(f"Total rows processed: {total_lines_processed}")
+    seconds = time.perf_counter() - start
+    print(f"Total rows processed: {total_lines_processed} in {seconds:.1f}s ({total_lines_processed / max(seconds, 1e-9):.0f} rows/s)")
 
 if __name__ == "__main__":
     months = [2, 3]
@@ -0,0 +1,82 @@
+from pathlib import Path
+from prefect import flow, task
+from prefect_gcp import GcpCredentials
+import tempfile
+import time
+import sys
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(str(Path(__file__).resolve().parents[2] / "0_common"))
+from gcs_parquet import download_from_gcs, integer_columns, rewrite_parquet
+from instrumentation import instrumented
+
+PROJECT_ID = "dezoomcamp-green-taxi"
+# Per color: the pickup column the tables are partitioned on (by day) and the columns they are clustered on
+PARTITIONING = {"fhv": ("pickup_datetime", ["PUlocationID", "DOlocationID"]),
+                "green": ("lpep_pickup_datetime", ["PULocationID", "DOLocationID"]),
+                "yellow": ("tpep_pickup_datetime", ["PULocationID", "DOLocationID"])}
+
+@task()
+@instrumented()
+def to_microseconds(path: Path, save_to: Path, color: str) -> int:
+    """Rewrite a parquet file with microsecond timestamps and integer location IDs, which BigQuery can partition and cluster on
+
+    The fhv location IDs are nullable, so pandas wrote them as floats; BigQuery cannot cluster on FLOAT64.
+    """
+    _, cluster_columns = PARTITIONING[color]
+    return rewrite_parquet(path, save_to, lambda table: integer_columns(table, cluster_columns))
+
+@task(retries=3)
+@instrumented()
+def load_partitioned(path: Path, color: str, year: int, month: int, destination_table: str) -> int:
+    """Replace the month in a date partitioned, location clustered table with a parquet load job"""
+    from google.cloud import bigquery
+    from google.api_core.exceptions import NotFound
+    client = GcpCredentials.load("dezoomcamp-gcp-creds").get_bigquery_client(project=PROJECT_ID)
+    table = f"{PROJECT_ID}.{destination_table}"
+    pickup_column, cluster_columns = PARTITIONING[color]
+
+    # Reruns of a month replace it; the filter on the partition column only touches its partitions
+    start = f"{year}-{month:02}-01"
+    end = f"{year + month // 12}-{month % 12 + 1:02}-01"
+    try:
+        client.query(f"DELETE FROM `{table}` WHERE {pickup_column} >= TIMESTAMP('{start}') "
+                     f"AND {pickup_column} < TIMESTAMP('{end}')").result()
+    except NotFound:
+        # The first load creates the table
+        pass
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        time_partitioning=bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field=pickup_column),
+        clustering_fields=cluster_columns)
+    with open(path, 'rb') as fd:
+        job = client.load_table_from_file(fd, table, job_config=job_config)
+    return job.result().output_rows
+
+@flow(log_prints=True)
+def etl_gcs_to_bq(color: str, year: int, month: int, destination_table: str = "fhv.tripdata_partitioned") -> int:
+    """Load a month from GCS into the partitioned table; the local files only live in a temporary folder"""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as folder:
+        path = download_from_gcs(color, year, month, folder)
+        converted = Path(folder) / f"us_{path.name}"
+        to_microseconds(path, converted, color)
+        path.unlink()
+        rows = load_partitioned(converted, color, year, month, destination_table)
+    seconds = time.perf_counter() - start
+    print(f"{color} {year}-{month:02}: {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    return rows
+
+@flow(log_prints=True)
+def etl_gcs_to_bq_parent(color: str, year: int, months: list[int], destination_table: str = "fhv.tripdata_partitioned") -> None:
+    total = 0
+    for month in months:
+        total += etl_gcs_to_bq(color=color, year=year, month=month, destination_table=destination_table)
+    print(f"Total rows loaded: {total}")
+
+if __name__ == "__main__":
+    color = "fhv"
+    year = 2019
+    months = list(range(1,13))
+    etl_gcs_to_bq_parent(color=color, year=year, months=months)
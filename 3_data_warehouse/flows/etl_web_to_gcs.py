@@ -1,32 +1,41 @@
 from pathlib import Path
 import pandas as pd
+import pyarrow.parquet as pq
 from prefect import flow, task
 from prefect_gcp.cloud_storage import GcsBucket
 import os
-from prefect.tasks import task_input_hash
-from datetime import timedelta
+import sys
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(str(Path(__file__).resolve().parents[2] / "0_common"))
+from artifact_cache import CACHE
+from instrumentation import DEBUG, instrumented
+from streaming_fetch import stream_csv_to_parquet
 
 LOCAL_PATH = "/Users/dg/Downloads/dezoomcamp"
 
-@task(retries=3, cache_key_fn=task_input_hash, cache_expiration=timedelta(days=1))
+@task(retries=3)
+@instrumented()
 def fetch(dataset_url: str) -> pd.DataFrame:
-    """Read taxi data from web into pandas DataFrame"""
-    df = pd.read_csv(dataset_url)
+    """Read taxi data from web into pandas DataFrame, through the local artifact cache"""
+    df = CACHE.fetch(dataset_url, lambda: pd.read_csv(dataset_url))
     return df
 
 @task(log_prints=True)
+@instrumented()
 def clean(df = pd.DataFrame) -> pd.DataFrame:
     """Fix dtype issues"""
     #df['lpep_pickup_datetime'] = pd.to_datetime(df['lpep_pickup_datetime'])
     #df['lpep_dropoff_datetime'] = pd.to_datetime(df['lpep_dropoff_datetime'])
 
-    print(df.head(2))
-    print(f"columns: {df.dtypes}")
+    if DEBUG:
+        print(df.head(2))
+        print(f"columns: {df.dtypes}")
     print(f"rows: {len(df)}")
 
     return df
 
 @task(log_prints=True)
+@instrumented()
 def write_local(df: pd.DataFrame, dataset_file:str) -> Path:
     """Write dataframe out as parquet file"""
 
@@ -38,7 +47,17 @@ def write_local(df: pd.DataFrame, dataset_file:str) -> Path:
     print(f"Saved local file to {path}")
     return path
 
+@task(retries=3, log_prints=True)
+@instrumented()
+def fetch_to_parquet(dataset_url: str, color: str, dataset_file: str) -> Path:
+    """Stream taxi data from the web (or a local file) into a local parquet file, with bounded memory"""
+    path = Path(f"{LOCAL_PATH}/data/{dataset_file}.parquet")
+    rows = stream_csv_to_parquet(dataset_url, path, color)
+    print(f"rows: {rows}")
+    return path
+
 @task()
+@instrumented()
 def write_gcs(path: Path) -> None:
     """Upload local parquet file to GCS"""
     gcp_cloud_storage_bucket_block = GcsBucket.load("dezoomcamp-gcs")
@@ -48,11 +67,21 @@ def write_gcs(path: Path) -> None:
     )
 
 @flow()
-def etl_web_to_gcs(color:str, year:int, month:int) -> None:
-    """The main ETL function"""
+def etl_web_to_gcs(color:str, year:int, month:int, streaming:bool=False, source_folder:str=None) -> None:
+    """The main ETL function
+
+    streaming converts the CSV to parquet chunk by chunk instead of in one DataFrame;
+    source_folder reads <source_folder>/<dataset_file>.csv.gz instead of downloading it.
+    """
     dataset_file = f"{color}_tripdata_{year}-{month:02}"
     dataset_url = f"https://github.com/DataTalksClub/nyc-tlc-data/releases/download/{color}/{dataset_file}.csv.gz"
+    if source_folder:
+        dataset_url = f"{source_folder}/{dataset_file}.csv.gz"
     #dataset_url = f"https://github.com/DataTalksClub/nyc-tlc-data/releases/download/fhv/fhv_tripdata_2019-01.csv.gz"
+    if streaming:
+        path = fetch_to_parquet(dataset_url, color, dataset_file)
+        write_gcs(path)
+        return pq.read_metadata(path).num_rows
     df = fetch(dataset_url)
     df_clean = clean(df)
     path = write_local(df_clean, dataset_file)
@@ -60,9 +89,9 @@ def etl_web_to_gcs(color:str, year:int, month:int) -> None:
     return len(df)
 
 @flow(log_prints=True)
-def etl_web_to_gcs_parent(color:str, year:int, months:list[int]) -> None:
+def etl_web_to_gcs_parent(color:str, year:int, months:list[int], streaming:bool=False, source_folder:str=None) -> None:
     for month in months:
-        etl_web_to_gcs(color=color, year=year, month=month)
+        etl_web_to_gcs(color=color, year=year, month=month, streaming=streaming, source_folder=source_folder)
 
 if __name__ == "__main__":
     color = "fhv"
@@ -0,0 +1,15 @@
+{#
+    Filter of the incremental models: on incremental runs only the trips picked up after the
+    ones already in the model are selected, so a monthly run reads only the new month.
+    On BigQuery the models are partitioned by day and use insert_overwrite: _dbt_max_partition
+    is a scripting variable, so the filter prunes the partitions of the source.
+#}
+{% macro new_pickups_only(column='pickup_datetime') %}
+{% if is_incremental() %}
+  {% if target.type == 'bigquery' %}
+    where date({{ column }}) >= date(_dbt_max_partition)
+  {% else %}
+    where {{ column }} > (select max({{ column }}) from {{ this }})
+  {% endif %}
+{% endif %}
+{% endmacro %}
@@ -1,8 +1,14 @@
-{{ config(materialized='table') }}
+{{ config(
+    materialized='incremental',
+    incremental_strategy='insert_overwrite' if target.type == 'bigquery' else 'append',
+    partition_by={'field': 'pickup_datetime', 'data_type': 'timestamp', 'granularity': 'day'},
+    cluster_by=['pickup_locationid', 'dropoff_locationid']
+) }}
 
 with fhv_trips as (
     select * 
     from {{ ref('stg_fhv_tripdata') }}
+    {{ new_pickups_only('pickup_datetime') }}
 ), 
 
 dim_zones as (
@@ -1,4 +1,9 @@
-{{ config(materialized='view') }}
+{{ config(
+    materialized='incremental',
+    incremental_strategy='insert_overwrite' if target.type == 'bigquery' else 'append',
+    partition_by={'field': 'pickup_datetime', 'data_type': 'timestamp', 'granularity': 'day'},
+    cluster_by=['pickup_locationid', 'dropoff_locationid']
+) }}
 
 select 
 -- identifiers
@@ -29,7 +34,8 @@ select
 --    cast(total_amount as numeric) as total_amount,
 --    cast(payment_type as integer) as payment_type,
 --    cast(congestion_surcharge as numeric) as congestion_surcharge
-from {{ source('staging', 'tripdata_non_partitioned') }}
+from {{ source('staging', 'tripdata_partitioned') }}
+{{ new_pickups_only('pickup_datetime') }}
 
 -- dbt build --m <model.sql> --var 'is_test_run: false'
 {% if var('is_test_run', default=true) %}
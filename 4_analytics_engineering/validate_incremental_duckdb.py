@@ -0,0 +1,142 @@
+"""Validate the incremental dbt models of dezoomcamp_fhv offline, on DuckDB.
+
+Builds a DuckDB stand-in of fhv.tripdata_partitioned with synthetic months, stored in pickup and
+location order like the partitioned, clustered BigQuery table, then:
+  1. builds the models from scratch on all months but the last one,
+  2. adds the last month and runs the models incrementally,
+  3. compares the row counts with a full refresh,
+and reports the rows and estimated bytes (BigQuery sizes) each model scans, for a full refresh
+and for the incremental run. DuckDB skips the row groups outside the filter with its zone maps,
+as BigQuery skips the partitions.
+
+Needs dbt-duckdb:
+    pip install dbt-duckdb
+    python validate_incremental_duckdb.py --months 3 --rows_per_month 500000
+"""
+import json
+import os
+import tempfile
+from argparse import ArgumentParser
+
+import duckdb
+from dbt.cli.main import dbtRunner
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dezoomcamp_fhv")
+MODELS = ["stg_fhv_tripdata", "fact_trips"]
+PROFILES = """default:
+  target: duckdb
+  outputs:
+    duckdb:
+      type: duckdb
+      path: {path}
+      threads: 1
+"""
+
+def add_month(con, year: int, month: int, rows: int) -> None:
+    """Insert a month of synthetic trips into the source table, in pickup and location order.
+
+    The location IDs are floats with missing values, as in the fhv parquet files.
+    """
+    con.execute(f"""
+        INSERT INTO fhv.tripdata_partitioned
+        SELECT 'B0' || (i % 900)::VARCHAR AS dispatching_base_num,
+               pickup_datetime,
+               pickup_datetime + INTERVAL 20 MINUTE AS dropOff_datetime,
+               IF(i % 5 = 0, NULL, (i * 7919) % 265 + 1)::DOUBLE AS PUlocationID,
+               IF(i % 7 = 0, NULL, (i * 104729) % 265 + 1)::DOUBLE AS DOlocationID,
+               NULL::DOUBLE AS SR_Flag,
+               'B0' || (i % 700)::VARCHAR AS Affiliated_base_number
+        FROM (SELECT i, TIMESTAMP '{year}-{month:02}-01' + to_seconds((i * (28 * 86400 // {rows}))::BIGINT) AS pickup_datetime
+              FROM range({rows}) t(i))
+        ORDER BY pickup_datetime, PUlocationID""")
+
+def scan(con, sql: str, profile_path: str) -> int:
+    """Rows a query scans, from the DuckDB profiler"""
+    con.execute("PRAGMA enable_profiling='json'")
+    con.execute(f"PRAGMA profiling_output='{profile_path}'")
+    con.execute("""SET custom_profiling_settings='{"CUMULATIVE_ROWS_SCANNED": "true"}'""")
+    # Aggregate every column so they are all read, like the model does; a bare count(*) is answered from
+    # the table statistics, without a profile. The compiled models end with a comment line.
+    con.execute(f"SELECT max(COLUMNS(*)) FROM (\n{sql}\n) AS model").fetchall()
+    con.execute("PRAGMA disable_profiling")
+    with open(profile_path) as fd:
+        return json.load(fd)["cumulative_rows_scanned"]
+
+def row_bytes(con) -> float:
+    """Average bytes of a row of the columns the staging model reads, with BigQuery's type sizes"""
+    return con.execute("""SELECT avg(2 + length(dispatching_base_num)) + 4 * 8
+                          FROM fhv.tripdata_partitioned""").fetchone()[0]
+
+class Dbt:
+    def __init__(self, folder: str, database: str):
+        self.args = ["--project-dir", PROJECT_DIR, "--profiles-dir", folder,
+                     "--target-path", os.path.join(folder, "target"), "--log-path", os.path.join(folder, "logs"),
+                     "--vars", json.dumps({"is_test_run": False, "source_database": database})]
+
+    def __call__(self, *command):
+        result = dbtRunner().invoke(list(command) + self.args)
+        if not result.success:
+            raise RuntimeError(f"dbt {' '.join(command)} failed: {result.exception}")
+        return result.result
+
+    def compiled(self, model: str, full_refresh: bool) -> str:
+        results = self("compile", "--select", model, *(["--full-refresh"] if full_refresh else []))
+        return results.results[0].node.compiled_code
+
+def counts(con) -> dict:
+    return {model: con.execute(f"SELECT count(*) FROM main.{model}").fetchone()[0] for model in MODELS}
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--year', type=int, default=2019)
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--rows_per_month', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "fhv_validation.duckdb")
+        with open(os.path.join(folder, "profiles.yml"), "w") as fd:
+            fd.write(PROFILES.format(path=path))
+        dbt = Dbt(folder, database="fhv_validation")
+        profile_path = os.path.join(folder, "profile.json")
+
+        with duckdb.connect(path) as con:
+            con.execute("CREATE SCHEMA fhv")
+            con.execute("""CREATE TABLE fhv.tripdata_partitioned (dispatching_base_num VARCHAR, pickup_datetime TIMESTAMP,
+                           dropOff_datetime TIMESTAMP, PUlocationID DOUBLE, DOlocationID DOUBLE, SR_Flag DOUBLE,
+                           Affiliated_base_number VARCHAR)""")
+            for month in range(1, args.months):
+                add_month(con, args.year, month, args.rows_per_month)
+        dbt("seed")
+        dbt("run", "--full-refresh")
+
+        with duckdb.connect(path) as con:
+            add_month(con, args.year, args.months, args.rows_per_month)
+            source_rows = con.execute("SELECT count(*) FROM fhv.tripdata_partitioned").fetchone()[0]
+            width = row_bytes(con)
+
+        report = []
+        for model in MODELS:
+            # Compile both versions against the state before the incremental run of the model
+            full_sql, incremental_sql = dbt.compiled(model, full_refresh=True), dbt.compiled(model, full_refresh=False)
+            with duckdb.connect(path) as con:
+                full, incremental = scan(con, full_sql, profile_path), scan(con, incremental_sql, profile_path)
+            report.append((model, full, incremental))
+            dbt("run", "--select", model)
+
+        with duckdb.connect(path) as con:
+            incremental_counts = counts(con)
+        dbt("run", "--full-refresh")
+        with duckdb.connect(path) as con:
+            full_counts = counts(con)
+
+    print(f"source rows: {source_rows} ({args.months} months of {args.rows_per_month})")
+    for model in MODELS:
+        status = "OK" if incremental_counts[model] == full_counts[model] else "MISMATCH"
+        print(f"{model}: {incremental_counts[model]} rows incremental, {full_counts[model]} rows full refresh: {status}")
+    for model, full, incremental in report:
+        print(f"{model} scans: full refresh {full} rows (~{full * width / 2**20:.1f} MB), "
+              f"incremental {incremental} rows (~{incremental * width / 2**20:.1f} MB), "
+              f"{incremental / max(full, 1):.0%} of the full scan")
+    if incremental_counts != full_counts or incremental_counts["stg_fhv_tripdata"] != source_rows:
+        raise SystemExit("The incremental models do not match a full refresh")
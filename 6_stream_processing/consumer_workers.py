@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+'''Run N consumer workers of one consumer group, as processes or threads.
+
+Every worker is a micro-batch consumer (see consume_batches in kafka_consumer.py) on the same
+subscription, so Kafka spreads the partitions over the workers and moves them on rebalances.
+A partition belongs to one worker at a time and its batches are processed in order, which keeps
+the order per key; with processes the decoding and processing of the partitions runs on several
+cores (threads share one core for Python code, and suit I/O bound processing).
+
+--reset rewinds the group to the beginning of the topic once, before the workers start, instead
+of on every assignment: a partition that moves to another worker then resumes from its last
+committed offset rather than being read again.
+
+Every worker reports its consumed messages per partition; the runner prints the throughput per
+worker and per partition.
+'''
+import sys
+import time
+import queue
+import threading
+import multiprocessing
+from argparse import ArgumentParser, FileType, Namespace
+from configparser import ConfigParser
+from confluent_kafka import Consumer, TopicPartition
+from kafka_consumer import consume_batches, load_processor, PROCESSORS
+
+def reset_group_offsets(config, topic):
+    '''Commit the beginning of every partition of the topic for the consumer group'''
+    consumer = Consumer(dict(config, **{'enable.auto.commit': False}))
+    try:
+        partitions = consumer.list_topics(topic, timeout=10).topics[topic].partitions
+        offsets = []
+        for partition in partitions:
+            low, _ = consumer.get_watermark_offsets(TopicPartition(topic, partition), timeout=10)
+            offsets.append(TopicPartition(topic, partition, low))
+        consumer.commit(offsets=offsets, asynchronous=False)
+        print("Reset group {} to the beginning of {} partitions".format(config['group.id'], len(offsets)))
+    finally:
+        consumer.close()
+
+def group_lag(config, topic):
+    '''Messages of the topic that the consumer group has not committed yet, over all its partitions'''
+    consumer = Consumer(dict(config, **{'enable.auto.commit': False}))
+    try:
+        partitions = consumer.list_topics(topic, timeout=10).topics[topic].partitions
+        lag = 0
+        for tp in consumer.committed([TopicPartition(topic, partition) for partition in partitions], timeout=10):
+            low, high = consumer.get_watermark_offsets(tp, timeout=10)
+            if tp.offset >= 0:
+                lag += high - tp.offset
+            elif config.get('auto.offset.reset', 'latest') in ('earliest', 'smallest', 'beginning'):
+                # Never committed: a worker would start from the beginning
+                lag += high - low
+        return lag
+    finally:
+        consumer.close()
+
+def run_worker(worker_id, config, topic, options, stop, reports):
+    '''Consume in micro-batches until stop is set, sending (worker_id, partition, messages) reports'''
+    consumer = Consumer(dict(config, **{'enable.auto.commit': False}))
+
+    def on_assign(consumer, partitions):
+        print("worker {}: assigned partitions {}".format(worker_id, [p.partition for p in partitions]))
+
+    def on_revoke(consumer, partitions):
+        # Batches are committed as soon as they are processed: nothing is left to commit here
+        print("worker {}: revoked partitions {}".format(worker_id, [p.partition for p in partitions]))
+
+    def on_commit(messages):
+        counts = {}
+        for msg in messages:
+            counts[msg.partition()] = counts.get(msg.partition(), 0) + 1
+        for partition, count in counts.items():
+            reports.put((worker_id, partition, count))
+
+    consumer.subscribe([topic], on_assign=on_assign, on_revoke=on_revoke, on_lost=on_revoke)
+    process = load_processor(options.processor, options)
+    try:
+        consume_batches(consumer, process, options.batch_size, options.batch_timeout, report_interval=None,
+                        idle_timeout=options.idle_timeout, should_stop=stop.is_set, on_commit=on_commit)
+    finally:
+        if hasattr(process, 'close'):
+            process.close()
+        # Leave the group, so its partitions are reassigned right away
+        consumer.close()
+
+class Throughput:
+    '''Messages consumed per worker and per partition'''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.workers = {}
+        self.partitions = {}
+
+    def add(self, worker_id, partition, count):
+        self.workers[worker_id] = self.workers.get(worker_id, 0) + count
+        self.partitions[partition] = self.partitions.get(partition, 0) + count
+
+    def report(self):
+        seconds = max(time.perf_counter() - self.start, 1e-9)
+        print("{total} consumed in {seconds:.1f}s: {rate:.0f} msgs/s".format(
+            total=sum(self.workers.values()), seconds=seconds, rate=sum(self.workers.values()) / seconds))
+        for worker_id, count in sorted(self.workers.items()):
+            print("  worker {:>3}: {:>10} messages, {:>8.0f} msgs/s".format(worker_id, count, count / seconds))
+        for partition, count in sorted(self.partitions.items()):
+            print("  partition {:>3}: {:>10} messages, {:>8.0f} msgs/s".format(partition, count, count / seconds))
+
+def run_workers(config, topic, options, workers=2, mode='process', report_interval=5.0, lag_check_interval=2.0):
+    '''Run the workers until they stop (idle timeout) or Ctrl+C, and return the Throughput.
+
+    A worker that idles out only drained its own partitions, which then move to the other workers.
+    Once one has stopped, the runner checks the lag of the group and stops the remaining workers
+    (also the ones without partitions, which never idle out) only when all of the topic is committed.
+    '''
+    if mode == 'process':
+        # librdkafka clients do not survive a fork: start the workers from a fresh interpreter
+        context = multiprocessing.get_context('spawn')
+        stop, reports = context.Event(), context.Queue()
+        make = context.Process
+    else:
+        stop, reports = threading.Event(), queue.Queue()
+        make = threading.Thread
+    runners = [make(target=run_worker, args=(worker_id, config, topic, options, stop, reports), daemon=True)
+               for worker_id in range(workers)]
+    for runner in runners:
+        runner.start()
+
+    throughput = Throughput()
+    next_report = time.perf_counter() + report_interval
+    next_lag_check = 0
+    try:
+        while any(runner.is_alive() for runner in runners) or not reports.empty():
+            try:
+                throughput.add(*reports.get(timeout=0.5))
+            except queue.Empty:
+                pass
+            if not stop.is_set() and not all(runner.is_alive() for runner in runners) \
+                    and time.perf_counter() >= next_lag_check:
+                lag = group_lag(config, topic)
+                if lag == 0:
+                    print("The group has committed all of {}: stopping the workers".format(topic))
+                    stop.set()
+                next_lag_check = time.perf_counter() + lag_check_interval
+            if time.perf_counter() >= next_report:
+                throughput.report()
+                next_report = time.perf_counter() + report_interval
+    except KeyboardInterrupt:
+        stop.set()
+    for runner in runners:
+        runner.join()
+    while not reports.empty():
+        throughput.add(*reports.get())
+    throughput.report()
+    return throughput
+
+if __name__ == '__main__':
+    # Parse the command line.
+    parser = ArgumentParser()
+    parser.add_argument('--config_file', type=FileType('r'),
+                        default='/Users/dg/Downloads/dezoomcamp/6_stream_processing/kafka_config.ini')
+    parser.add_argument('--reset', action='store_true')
+    parser.add_argument('--topic', default="topic_0_tutorial")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--mode', choices=['process', 'thread'], default='process')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--batch_timeout', type=float, default=1.0, help='seconds to wait for a full batch')
+    parser.add_argument('--processor', default='count',
+                        help='processing function of the batches: {} or module:function'.format('|'.join(PROCESSORS)))
+    parser.add_argument('--output_folder', default='stream_output', help='folder of the parquet processor')
+    parser.add_argument('--report_interval', type=float, default=5.0, help='seconds between throughput reports')
+    parser.add_argument('--idle_timeout', type=float, default=None, help='stop after this many seconds without messages')
+    parser.add_argument('--local_broker', type=int, default=None, metavar='N',
+                        help='consume from an in-process stand-in broker (see local_broker.py) loaded with N random events')
+    args = parser.parse_args()
+
+    # Parse the configuration.
+    # See https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
+    config_parser = ConfigParser()
+    config_parser.read_file(args.config_file)
+    config = dict(config_parser['default'])
+    config.update(config_parser['consumer'])
+
+    if args.local_broker is not None:
+        from confluent_kafka import Producer
+        from local_broker import LocalBroker
+        from kafka_producer import produce_load, random_events
+        broker = LocalBroker()
+        config = dict(broker.config(), **config_parser['consumer'])
+        produce_load(Producer(broker.config()), args.topic, random_events(), args.local_broker)
+        if args.idle_timeout is None:
+            args.idle_timeout = 5.0
+
+    if args.reset:
+        reset_group_offsets(config, args.topic)
+
+    options = Namespace(processor=args.processor, output_folder=args.output_folder, batch_size=args.batch_size,
+                        batch_timeout=args.batch_timeout, idle_timeout=args.idle_timeout)
+    run_workers(config, args.topic, options, args.workers, args.mode, args.report_interval)
+    sys.exit(0)
@@ -1,14 +1,183 @@
+#!/usr/bin/env python
+
+import os
 import sys
+import time
+import importlib
 from argparse import ArgumentParser, FileType
 from configparser import ConfigParser
-from confluent_kafka import Consumer, OFFSET_BEGINNING
+from confluent_kafka import Consumer, KafkaError, KafkaException, TopicPartition, OFFSET_BEGINNING
+
+# Commit errors of a consumer whose partitions were reassigned in the meantime
+REBALANCE_ERRORS = {KafkaError.REBALANCE_IN_PROGRESS, KafkaError.ILLEGAL_GENERATION, KafkaError.UNKNOWN_MEMBER_ID}
+
+def decode(msg):
+    '''(key, value) strings of a message'''
+    key = msg.key()
+    return (key.decode('utf-8') if key is not None else None), msg.value().decode('utf-8')
+
+def print_batch(messages):
+    '''Processing function of the tutorial: print every event'''
+    for msg in messages:
+        key, value = decode(msg)
+        print("Consumed event from topic {topic}: key = {key:12} value = {value:12}".format(
+            topic=msg.topic(), key=f"{key}", value=value))
+
+class CountAggregator:
+    '''Processing function counting the events per (key, value), e.g. per user and product, with pandas'''
+    def __init__(self):
+        self.counts = None
+
+    def __call__(self, messages):
+        import pandas as pd
+        counts = pd.DataFrame([decode(msg) for msg in messages], columns=['key', 'value']).value_counts()
+        self.counts = counts if self.counts is None else self.counts.add(counts, fill_value=0).astype('int64')
+
+    def close(self):
+        if self.counts is not None:
+            print(self.counts.sort_values(ascending=False).head(20))
+
+class ParquetSink:
+    '''Processing function writing every batch as one parquet file per partition:
+    <folder>/<topic>/partition=<partition>/<first offset>.parquet
+    The file is complete before the offsets of the batch are committed.'''
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __call__(self, messages):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        by_partition = {}
+        for msg in messages:
+            by_partition.setdefault((msg.topic(), msg.partition()), []).append(msg)
+        for (topic, partition), msgs in by_partition.items():
+            keys, values = zip(*map(decode, msgs))
+            table = pa.table({'offset': pa.array([msg.offset() for msg in msgs], pa.int64()),
+                              'timestamp': pa.array([msg.timestamp()[1] for msg in msgs], pa.timestamp('ms')),
+                              'key': pa.array(keys, pa.string()),
+                              'value': pa.array(values, pa.string())})
+            folder = os.path.join(self.folder, topic, f"partition={partition}")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"{msgs[0].offset():020}.parquet")
+            pq.write_table(table, f"{path}.part")
+            os.replace(f"{path}.part", path)
+
+PROCESSORS = {'print': lambda args: print_batch,
+              'count': lambda args: CountAggregator(),
+              'parquet': lambda args: ParquetSink(args.output_folder)}
+
+def load_processor(name, args):
+    '''A processing function of PROCESSORS, or any callable(messages) given as module:function'''
+    if name in PROCESSORS:
+        return PROCESSORS[name](args)
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
+
+def consumer_lag(consumer):
+    '''Messages behind the end of every assigned partition.
+
+    Uses the high watermarks cached from the last fetch of every partition, so it costs no broker
+    round trip; a partition that was not fetched from yet is left out.
+    '''
+    lag = {}
+    assignment = consumer.assignment()
+    for tp in consumer.position(assignment) if assignment else []:
+        low, high = consumer.get_watermark_offsets(tp, cached=True)
+        if high >= 0 and tp.offset >= 0:
+            lag[(tp.topic, tp.partition)] = high - tp.offset
+    return lag
+
+def batch_offsets(messages):
+    '''Offsets to commit after a batch: the next offset of every partition in it'''
+    offsets = {}
+    for msg in messages:
+        offsets[(msg.topic(), msg.partition())] = max(offsets.get((msg.topic(), msg.partition()), -1), msg.offset() + 1)
+    return [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
+
+def consume_batches(consumer, process, batch_size=1000, timeout=1.0, report_interval=5.0,
+                    max_messages=None, idle_timeout=None, should_stop=None, on_commit=None):
+    '''Hand micro-batches of up to batch_size messages to process(messages), then commit their offsets.
+
+    Needs enable.auto.commit=false: an offset is only committed after its batch was processed, so
+    a crash replays the unprocessed batch instead of losing it. Stops after max_messages, after
+    idle_timeout seconds without messages once partitions are assigned, when should_stop()
+    returns True, or on Ctrl+C. on_commit(messages) is called after every commit.
+    Returns the number of processed messages.
+
+    The rebalance callbacks run inside consume(), between two batches, so every batch is processed
+    and committed before its partitions can be revoked.
+    '''
+    start = last_message = time.perf_counter()
+    next_report = start + (report_interval or 0)
+    consumed = batches = 0
+    try:
+        while (max_messages is None or consumed < max_messages) and not (should_stop and should_stop()):
+            messages = consumer.consume(batch_size, timeout)
+            now = time.perf_counter()
+            if not messages:
+                # Initial message consumption may take up to
+                # `session.timeout.ms` for the consumer group to
+                # rebalance and start consuming
+                if not consumer.assignment():
+                    # Idle time only counts once partitions are assigned
+                    last_message = now
+                elif idle_timeout is not None and now - last_message > idle_timeout:
+                    break
+            else:
+                last_message = now
+                valid = []
+                for msg in messages:
+                    if not msg.error():
+                        valid.append(msg)
+                    elif msg.error().code() != KafkaError._PARTITION_EOF:
+                        print("ERROR: {}".format(msg.error()))
+                if valid:
+                    process(valid)
+                    try:
+                        consumer.commit(offsets=batch_offsets(valid), asynchronous=False)
+                    except KafkaException as e:
+                        if e.args[0].code() not in REBALANCE_ERRORS:
+                            raise
+                        # The partitions moved to another consumer while the batch was processed:
+                        # it consumes them again from the last committed offsets
+                        print("Commit skipped: {}".format(e.args[0].str()))
+                    else:
+                        if on_commit:
+                            on_commit(valid)
+                    consumed += len(valid)
+                    batches += 1
+
+            if report_interval is not None and now >= next_report:
+                lag = consumer_lag(consumer)
+                print("{consumed} consumed in {batches} batches, {rate:.0f} msgs/s, lag {total} {lag}".format(
+                    consumed=consumed, batches=batches, rate=consumed / (now - start),
+                    total=sum(lag.values()), lag={partition: behind for (_, partition), behind in sorted(lag.items())}))
+                next_report = now + report_interval
+    except KeyboardInterrupt:
+        pass
+    seconds = time.perf_counter() - start
+    print("{consumed} consumed in {batches} batches in {seconds:.1f}s: {rate:.0f} msgs/s".format(
+        consumed=consumed, batches=batches, seconds=seconds, rate=consumed / max(seconds, 1e-9)))
+    return consumed
 
 if __name__ == '__main__':
     # Parse the command line.
     parser = ArgumentParser()
-    parser.add_argument('--config_file', type=FileType('r'), 
+    parser.add_argument('--config_file', type=FileType('r'),
                         default='/Users/dg/Downloads/dezoomcamp/6_stream_processing/kafka_config.ini')
     parser.add_argument('--reset', action='store_true')
+    parser.add_argument('--topic', default="topic_0_tutorial")
+    parser.add_argument('--batch', action='store_true',
+                        help='consume micro-batches, process them and commit their offsets manually')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--batch_timeout', type=float, default=1.0, help='seconds to wait for a full batch')
+    parser.add_argument('--processor', default='print',
+                        help='processing function of the batches: {} or module:function'.format('|'.join(PROCESSORS)))
+    parser.add_argument('--output_folder', default='stream_output', help='folder of the parquet processor')
+    parser.add_argument('--report_interval', type=float, default=5.0, help='seconds between throughput and lag reports')
+    parser.add_argument('--idle_timeout', type=float, default=None, help='stop after this many seconds without messages')
+    parser.add_argument('--local_broker', type=int, default=None, metavar='N',
+                        help='consume from an in-process stand-in broker (see local_broker.py) loaded with N random events')
     args = parser.parse_args()
 
     # Parse the configuration.
@@ -18,6 +187,20 @@ if __name__ == '__main__':
     config = dict(config_parser['default'])
     config.update(config_parser['consumer'])
 
+    if args.local_broker is not None:
+        from confluent_kafka import Producer
+        from local_broker import LocalBroker
+        from kafka_producer import produce_load, random_events
+        broker = LocalBroker()
+        config = dict(broker.config(), **config_parser['consumer'])
+        produce_load(Producer(broker.config()), args.topic, random_events(), args.local_broker)
+        if args.idle_timeout is None:
+            args.idle_timeout = 5.0
+
+    if args.batch:
+        # Offsets are committed by consume_batches after every processed batch
+        config['enable.auto.commit'] = False
+
     # Create Consumer instance
     consumer = Consumer(config)
 
@@ -29,9 +212,21 @@ if __name__ == '__main__':
             consumer.assign(partitions)
 
     # Subscribe to topic
-    topic = "topic_0_tutorial"
+    topic = args.topic
     consumer.subscribe([topic], on_assign=reset_offset)
 
+    if args.batch:
+        process = load_processor(args.processor, args)
+        try:
+            consume_batches(consumer, process, args.batch_size, args.batch_timeout, args.report_interval,
+                            idle_timeout=args.idle_timeout)
+        finally:
+            if hasattr(process, 'close'):
+                process.close()
+            # Leave group
+            consumer.close()
+        sys.exit(0)
+
     # Poll for new messages from Kafka and print them.
     try:
         while True:
@@ -52,4 +247,4 @@ if __name__ == '__main__':
         pass
     finally:
         # Leave group and commit final offsets
-        consumer.close()
\ No newline at end of file
+        consumer.close()
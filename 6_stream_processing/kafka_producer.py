@@ -1,17 +1,173 @@
 #!/usr/bin/env python
 
 import sys
+import time
+import random
 from random import choice
 from argparse import ArgumentParser, FileType
 from configparser import ConfigParser
+from itertools import islice
 from confluent_kafka import Producer
 
+# Batching used by the load mode, overridden by the [producer] section of the configuration file.
+# See https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
+LOAD_CONFIG = {'linger.ms': 20,
+               'batch.size': 1000000,
+               'compression.type': 'lz4',
+               'queue.buffering.max.messages': 500000,
+               'acks': 'all'}
+
+user_ids = ['eabara', 'jsmith', 'sgarcia', 'jbernard', 'htanaka', 'awalther']
+products = ['book', 'alarm clock', 't-shirts', 'gift card', 'batteries']
+
+def random_events():
+    '''Endless (key, value) events of the tutorial: a user buying a product'''
+    while True:
+        yield choice(user_ids), choice(products)
+
+def pickup_location_column(columns):
+    '''The pickup location column of a taxi file: PULocationID (green, yellow) or PUlocationID (fhv)'''
+    return next((col for col in columns if col.lower() == 'pulocationid'), None)
+
+def csv_events(path, key_column=None, chunksize=100000):
+    '''(key, value) events replaying the rows of a taxi CSV file as JSON, keyed by one of its columns.
+
+    Without key_column, the events are keyed by the pickup location of the file (unkeyed if it has none).
+    '''
+    import pandas as pd
+    for df in pd.read_csv(path, chunksize=chunksize):
+        column = key_column or pickup_location_column(df.columns)
+        if column is None:
+            keys = [None] * len(df)
+        else:
+            # The location ids of the fhv files are floats because of their missing values
+            keys = df[column].astype('Int64') if pd.api.types.is_float_dtype(df[column]) else df[column]
+            keys = [None if pd.isna(key) else str(key) for key in keys]
+        values = df.to_json(orient='records', lines=True, date_format='iso').splitlines()
+        yield from zip(keys, values)
+
+def replayed_csv_events(path, key_column=None):
+    '''Replay the file as many times as needed to reach the message count'''
+    while True:
+        events = 0
+        for event in csv_events(path, key_column):
+            events += 1
+            yield event
+        if not events:
+            # Replaying an empty file would loop forever
+            raise ValueError(f"{path} has no rows to replay")
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+class Reservoir:
+    '''Uniform random sample of at most size values of a stream, for percentiles in bounded memory'''
+    def __init__(self, size=10000):
+        self.size = size
+        self.seen = 0
+        self.values = []
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.size:
+                self.values[index] = value
+
+class DeliveryStats:
+    '''Counts the delivery reports instead of printing them, and keeps a sample of the delivery latencies'''
+    def __init__(self):
+        self.delivered = 0
+        self.failed = 0
+        self.bytes = 0
+        self.latencies = Reservoir()
+        # The maximum is exact, the sample would miss it
+        self.max_latency = float('nan')
+        self.last_error = None
+        # Messages still in the local queue when the final flush timed out
+        self.undelivered = 0
+
+    def __call__(self, err, msg):
+        if err:
+            self.failed += 1
+            self.last_error = err
+        else:
+            self.delivered += 1
+            self.bytes += len(msg.value())
+            # Seconds between produce() and the acknowledgement of the broker
+            latency = msg.latency()
+            self.latencies.add(latency)
+            self.max_latency = latency if self.delivered == 1 else max(self.max_latency, latency)
+
+    def summary(self, seconds):
+        latencies = sorted(latency * 1000 for latency in self.latencies.values)
+        return ("{delivered} delivered, {failed} failed in {seconds:.1f}s: {rate:.0f} msgs/s, {mb:.2f} MB/s, "
+                "latency p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, max {max:.1f} ms").format(
+                    delivered=self.delivered, failed=self.failed, seconds=seconds,
+                    rate=self.delivered / max(seconds, 1e-9), mb=self.bytes / 2**20 / max(seconds, 1e-9),
+                    p50=percentile(latencies, 50), p95=percentile(latencies, 95), p99=percentile(latencies, 99),
+                    max=self.max_latency * 1000)
+
+def produce_load(producer, topic, events, count, rate=0, report_interval=5.0):
+    '''Produce count events at a target rate (0 for as fast as possible) and return the delivery stats.
+
+    The delivery reports are served by poll(0) while producing, and the local queue is drained
+    with poll() whenever it is full instead of failing.
+    '''
+    stats = DeliveryStats()
+    start = time.perf_counter()
+    next_report = start + report_interval
+    sent = 0
+    for key, value in islice(events, count):
+        if rate:
+            # Wait for the schedule of the target rate, serving delivery reports meanwhile
+            delay = start + sent / rate - time.perf_counter()
+            if delay > 0:
+                producer.poll(delay)
+        while True:
+            try:
+                producer.produce(topic, value, key, on_delivery=stats)
+                break
+            except BufferError:
+                # Local queue full: wait for deliveries to free up room
+                producer.poll(0.1)
+        sent += 1
+        producer.poll(0)
+
+        now = time.perf_counter()
+        if now >= next_report:
+            print("{sent} sent, {delivered} delivered, {failed} failed, {rate:.0f} msgs/s".format(
+                sent=sent, delivered=stats.delivered, failed=stats.failed, rate=stats.delivered / (now - start)))
+            next_report = now + report_interval
+
+    # Block until the messages are sent.
+    stats.undelivered = producer.flush(60)
+    seconds = time.perf_counter() - start
+    print(stats.summary(seconds))
+    if stats.undelivered or stats.failed:
+        print('ERROR: {} messages not delivered ({} still queued after the final flush), last error: {}'.format(
+            stats.undelivered + stats.failed, stats.undelivered, stats.last_error))
+    return stats
+
 if __name__ == '__main__':
     # Parse the command line.
     parser = ArgumentParser()
-    parser.add_argument('--config_file', 
+    parser.add_argument('--config_file',
                         type = FileType('r'),
                         default='/Users/dg/Downloads/dezoomcamp/6_stream_processing/kafka_config.ini')
+    parser.add_argument('--topic', default="topic_0_tutorial")
+    parser.add_argument('--load', action='store_true',
+                        help='load generator mode: batched producer that reports throughput and latency')
+    parser.add_argument('--count', type=int, default=100000, help='number of messages in load mode')
+    parser.add_argument('--rate', type=float, default=0, help='target messages per second in load mode (0: unlimited)')
+    parser.add_argument('--csv', default=None, help='taxi CSV file whose rows are replayed as JSON events in load mode')
+    parser.add_argument('--key_column', default=None,
+                        help='CSV column used as message key (default: the pickup location column of the file)')
+    parser.add_argument('--report_interval', type=float, default=5.0, help='seconds between progress reports')
     args = parser.parse_args()
 
     # Parse the configuration.
@@ -19,6 +175,19 @@ if __name__ == '__main__':
     config_parser = ConfigParser()
     config_parser.read_file(args.config_file)
     config = dict(config_parser['default'])
+    topic = args.topic
+
+    if args.load:
+        config.update(LOAD_CONFIG)
+        if config_parser.has_section('producer'):
+            config.update(config_parser['producer'])
+        producer = Producer(config)
+        if args.csv:
+            events = replayed_csv_events(args.csv, args.key_column)
+        else:
+            events = random_events()
+        stats = produce_load(producer, topic, events, args.count, args.rate, args.report_interval)
+        sys.exit(1 if stats.failed or stats.undelivered else 0)
 
     # Create Producer instance
     producer = Producer(config)
@@ -34,10 +203,6 @@ if __name__ == '__main__':
                 topic=msg.topic(), key=msg.key().decode('utf-8'), value=msg.value().decode('utf-8')))
 
     # Produce data by selecting random values from these lists.
-    topic = "topic_0_tutorial"
-    user_ids = ['eabara', 'jsmith', 'sgarcia', 'jbernard', 'htanaka', 'awalther']
-    products = ['book', 'alarm clock', 't-shirts', 'gift card', 'batteries']
-
     count = 0
     for _ in range(10):
 
@@ -48,4 +213,4 @@ if __name__ == '__main__':
 
     # Block until the messages are sent.
     producer.poll(10000)
-    producer.flush()
\ No newline at end of file
+    producer.flush()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''In-process stand-in for a Kafka cluster, to try the producer and consumers without Confluent Cloud.
+
+librdkafka starts a mock cluster inside any client created with test.mock.num.brokers, and logs the
+address it listens on. LocalBroker keeps such a client alive and exposes that address, so regular
+producers and consumers (also in other threads and processes of this machine) can connect to it.
+The mock cluster supports producing, consumer groups, rebalances and committed offsets; it lives
+as long as the LocalBroker. Topics are created on first use, with 4 partitions.
+'''
+import logging
+import re
+import time
+from confluent_kafka import Producer
+
+class _AddressHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.address = None
+
+    def emit(self, record):
+        match = re.search(r'replaced with (\S+)', record.getMessage())
+        if match:
+            self.address = match.group(1)
+
+class LocalBroker:
+    def __init__(self, num_brokers=1):
+        self._handler = _AddressHandler()
+        logger = logging.getLogger('local_broker')
+        logger.addHandler(self._handler)
+        logger.setLevel(logging.INFO)
+        self._client = Producer({'test.mock.num.brokers': num_brokers, 'logger': logger})
+        deadline = time.time() + 10
+        while self._handler.address is None:
+            if time.time() > deadline:
+                raise RuntimeError('the mock cluster did not start')
+            self._client.poll(0.1)
+        self.bootstrap_servers = self._handler.address
+
+    def config(self):
+        '''Client configuration of the stand-in, in place of the [default] section'''
+        return {'bootstrap.servers': self.bootstrap_servers}
+
+    def close(self):
+        self._client.flush(1)
+        self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == '__main__':
+    # Keep a stand-in running for the scripts of this folder, e.g. with
+    # [default] bootstrap.servers=<printed address> in their configuration file.
+    with LocalBroker() as broker:
+        print("Local broker listening on {}".format(broker.bootstrap_servers))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+'''Windowed counts per user and product of the (user_id -> product) events of topic_0_tutorial.
+
+A processing function for consume_batches (kafka_consumer.py): every batch updates the counts of
+tumbling windows (--window) or sliding windows (--window with --slide) on the event time of the
+messages, and the updated counts are produced as JSON to an output topic:
+    key user_id, value {"window_start", "window_end", "user_id", "product", "count", "final"}
+
+The state stays bounded: a window is closed once the watermark (latest event time minus
+--lateness) passes its end, its final counts are emitted and it is dropped; later events for it are
+counted as late. At most --max_windows windows are open, the oldest is closed first; the events
+of the windows closed that way are counted as late as well, instead of opening them again. The
+update latencies are kept as a fixed-size random sample.
+
+The state and the next offset of every partition are snapshotted to --snapshot every
+--snapshot_interval seconds. On restart the snapshot is loaded and the partitions are read again
+from its offsets, so only the messages since the last snapshot are replayed.
+'''
+import os
+import sys
+import json
+import time
+import threading
+from argparse import ArgumentParser, FileType
+from configparser import ConfigParser
+from confluent_kafka import Consumer, Producer, OFFSET_BEGINNING
+from kafka_consumer import consume_batches, decode
+from kafka_producer import Reservoir, percentile
+
+class WindowedCounts:
+    def __init__(self, producer, output_topic, window_ms=60000, slide_ms=None, lateness_ms=5000,
+                 max_windows=100, snapshot_path=None, snapshot_interval=30.0):
+        self.producer = producer
+        self.output_topic = output_topic
+        self.window_ms = window_ms
+        # Tumbling windows slide by their own size
+        self.slide_ms = slide_ms or window_ms
+        self.lateness_ms = lateness_ms
+        self.max_windows = max_windows
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        # window start (ms) -> {(user_id, product): count}
+        self.windows = {}
+        self.offsets = {}
+        self.watermark = -1
+        # Windows are closed oldest first: every window starting at or before this one is closed
+        self.closed_until = -1
+        self.late = 0
+        self.latencies = Reservoir()
+        self.last_snapshot = time.perf_counter()
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.restore()
+
+    def window_starts(self, timestamp):
+        '''Starts of the windows an event time falls in'''
+        start = timestamp - timestamp % self.slide_ms
+        starts = []
+        while start > timestamp - self.window_ms:
+            starts.append(start)
+            start -= self.slide_ms
+        return starts
+
+    def __call__(self, messages):
+        updated = set()
+        for msg in messages:
+            timestamp = msg.timestamp()[1]
+            user_id, product = decode(msg)
+            self.offsets[f"{msg.topic()}:{msg.partition()}"] = msg.offset() + 1
+            for start in self.window_starts(timestamp):
+                if start + self.window_ms <= self.watermark or start <= self.closed_until:
+                    self.late += 1
+                    continue
+                counts = self.windows.setdefault(start, {})
+                counts[(user_id, product)] = counts.get((user_id, product), 0) + 1
+                updated.add((start, user_id, product))
+            self.watermark = max(self.watermark, timestamp - self.lateness_ms)
+
+        for start, user_id, product in updated:
+            if start in self.windows:
+                self.emit(start, user_id, product, self.windows[start][(user_id, product)], final=False)
+        self.close_windows()
+        self.producer.poll(0)
+        # Update latency: from the creation of the oldest event of the batch to the emission of its update
+        self.latencies.add(time.time() * 1000 - min(msg.timestamp()[1] for msg in messages))
+
+        if self.snapshot_path and time.perf_counter() - self.last_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    def close_windows(self):
+        '''Emit the final counts of the windows behind the watermark (or over max_windows) and drop them'''
+        for start in sorted(self.windows):
+            if start + self.window_ms > self.watermark and len(self.windows) <= self.max_windows:
+                break
+            for (user_id, product), count in self.windows.pop(start).items():
+                self.emit(start, user_id, product, count, final=True)
+            self.closed_until = max(self.closed_until, start)
+
+    def emit(self, start, user_id, product, count, final):
+        value = json.dumps({'window_start': start, 'window_end': start + self.window_ms, 'user_id': user_id,
+                            'product': product, 'count': count, 'final': final})
+        while True:
+            try:
+                self.producer.produce(self.output_topic, value, user_id)
+                break
+            except BufferError:
+                self.producer.poll(0.1)
+
+    def state_size(self):
+        return sum(len(counts) for counts in self.windows.values())
+
+    def snapshot(self):
+        '''Write the state and the offsets it covers to the snapshot file, atomically'''
+        state = {'windows': {str(start): [[user_id, product, count] for (user_id, product), count in counts.items()]
+                             for start, counts in self.windows.items()},
+                 'offsets': self.offsets,
+                 'watermark': self.watermark,
+                 'closed_until': self.closed_until}
+        with open(f"{self.snapshot_path}.part", 'w') as fd:
+            json.dump(state, fd)
+        os.replace(f"{self.snapshot_path}.part", self.snapshot_path)
+        self.last_snapshot = time.perf_counter()
+
+    def restore(self):
+        with open(self.snapshot_path) as fd:
+            state = json.load(fd)
+        self.windows = {int(start): {(user_id, product): count for user_id, product, count in counts}
+                        for start, counts in state['windows'].items()}
+        self.offsets = state['offsets']
+        self.watermark = state['watermark']
+        self.closed_until = state.get('closed_until', -1)
+        print("Restored {} windows ({} counts) from {}".format(len(self.windows), self.state_size(), self.snapshot_path))
+
+    def on_assign(self, consumer, partitions):
+        '''Resume the partitions of the snapshot from its offsets instead of the committed ones'''
+        for p in partitions:
+            offset = self.offsets.get(f"{p.topic}:{p.partition}")
+            if offset is not None:
+                p.offset = offset
+        consumer.assign(partitions)
+
+    def report(self):
+        latencies = sorted(self.latencies.values)
+        print("{windows} open windows, {size} counts, watermark {watermark}, {late} late events, "
+              "update latency p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms".format(
+                  windows=len(self.windows), size=self.state_size(), watermark=self.watermark, late=self.late,
+                  p50=percentile(latencies, 50), p95=percentile(latencies, 95), p99=percentile(latencies, 99)))
+
+    def close(self):
+        if self.snapshot_path:
+            self.snapshot()
+        self.producer.flush()
+        self.report()
+
+if __name__ == '__main__':
+    # Parse the command line.
+    parser = ArgumentParser()
+    parser.add_argument('--config_file', type=FileType('r'),
+                        default='/Users/dg/Downloads/dezoomcamp/6_stream_processing/kafka_config.ini')
+    parser.add_argument('--reset', action='store_true')
+    parser.add_argument('--topic', default="topic_0_tutorial")
+    parser.add_argument('--output_topic', default="topic_0_tutorial_counts")
+    parser.add_argument('--window', type=float, default=60.0, help='window size in seconds')
+    parser.add_argument('--slide', type=float, default=None, help='slide of sliding windows in seconds (default: tumbling)')
+    parser.add_argument('--lateness', type=float, default=5.0, help='seconds an event may arrive late')
+    parser.add_argument('--max_windows', type=int, default=100, help='maximum number of open windows')
+    parser.add_argument('--snapshot', default='windowed_counts.json', help='snapshot file of the state')
+    parser.add_argument('--snapshot_interval', type=float, default=30.0, help='seconds between snapshots')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--report_interval', type=float, default=5.0)
+    parser.add_argument('--idle_timeout', type=float, default=None, help='stop after this many seconds without messages')
+    parser.add_argument('--local_broker', type=int, default=None, metavar='N',
+                        help='run against an in-process stand-in broker (see local_broker.py) fed with N random events')
+    parser.add_argument('--rate', type=float, default=10000, help='events per second fed to the stand-in broker')
+    args = parser.parse_args()
+
+    # Parse the configuration.
+    # See https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
+    config_parser = ConfigParser()
+    config_parser.read_file(args.config_file)
+    producer_config = dict(config_parser['default'])
+    config = dict(config_parser['default'])
+    config.update(config_parser['consumer'])
+
+    if args.local_broker is not None:
+        from local_broker import LocalBroker
+        from kafka_producer import produce_load, random_events
+        broker = LocalBroker()
+        producer_config = broker.config()
+        config = dict(broker.config(), **config_parser['consumer'])
+        # Feed the input topic while aggregating, to measure the update latency under load
+        feeder = Producer(broker.config())
+        # Create the topic before subscribing to it
+        feeder.list_topics(args.topic, timeout=10)
+        feed = threading.Thread(target=produce_load, daemon=True,
+                                args=(feeder, args.topic, random_events(), args.local_broker, args.rate))
+        # The demo ends once the fed events are aggregated; on a real cluster the aggregation keeps running
+        if args.idle_timeout is None:
+            args.idle_timeout = 5.0
+    else:
+        feed = None
+
+    # Offsets are committed by consume_batches after every processed batch
+    config['enable.auto.commit'] = False
+    if args.reset and os.path.exists(args.snapshot):
+        os.remove(args.snapshot)
+
+    aggregation = WindowedCounts(Producer(producer_config), args.output_topic, int(args.window * 1000),
+                                 int(args.slide * 1000) if args.slide else None, int(args.lateness * 1000),
+                                 args.max_windows, args.snapshot, args.snapshot_interval)
+
+    def on_assign(consumer, partitions):
+        if feed is not None and feed.ident is None:
+            # Start feeding once the consumer joined, so the latency is not that of a backlog
+            feed.start()
+        if args.reset:
+            for p in partitions:
+                p.offset = OFFSET_BEGINNING
+            consumer.assign(partitions)
+        else:
+            aggregation.on_assign(consumer, partitions)
+
+    consumer = Consumer(config)
+    consumer.subscribe([args.topic], on_assign=on_assign)
+
+    next_report = [time.perf_counter() + args.report_interval]
+    def on_commit(messages):
+        if time.perf_counter() >= next_report[0]:
+            aggregation.report()
+            next_report[0] = time.perf_counter() + args.report_interval
+
+    try:
+        consume_batches(consumer, aggregation, args.batch_size, report_interval=args.report_interval,
+                        idle_timeout=args.idle_timeout, on_commit=on_commit)
+    finally:
+        aggregation.close()
+        consumer.close()
+    sys.exit(0)
@@ -0,0 +1,104 @@
+'''Benchmark the PriceToRentRatio join plans on synthetic data.
+
+Generates leases and transactions tables with the columns of the BigQuery *_all tables, runs
+price_to_rent_ratio with the original plan (sort-merge join + global sort) and with the
+co-partitioned and broadcast plans, and reports wall time and shuffle bytes of each run.
+
+Run from the 2_flows folder, for example:
+    python benchmark_join.py --scale municipality
+    python benchmark_join.py --scale statistical_unit --spark_master "local[8]"
+'''
+import json
+import os
+import tempfile
+import time
+import urllib.request
+from argparse import ArgumentParser
+
+from pyspark.sql import functions as F
+
+from etl_bq_pyspark_bq import LEASE_COLUMNS, TRANSACTION_COLUMNS, input_size, price_to_rent_ratio, read_input
+from spark_session import SPARK
+
+# (number of NIS codes, rows per NIS code and quarter)
+SCALES = {"municipality": (581, 40),
+          "statistical_unit": (19781, 20)}
+QUARTERS = 28  # 2016 to 2022
+
+PLANS = [("sort", None),
+         ("copartitioned", None),
+         ("copartitioned", "leases")]
+
+def generate(spark, path: str, action_type: str, nis_codes: int, rows_per_code: int) -> None:
+    '''Write a synthetic leases or transactions table as parquet'''
+    rows_per_quarter = nis_codes * rows_per_code
+    df = spark.range(rows_per_quarter * QUARTERS) \
+        .withColumn("NISCode", (F.col("id") % nis_codes + 10000).cast("string")) \
+        .withColumn("NameFre", F.concat(F.lit("Commune "), F.col("NISCode"))) \
+        .withColumn("NameDut", F.concat(F.lit("Gemeente "), F.col("NISCode"))) \
+        .withColumn("NameGer", F.concat(F.lit("Gemeinde "), F.col("NISCode"))) \
+        .withColumn("Date", F.last_day(F.add_months(F.lit("2016-03-01").cast("date"),
+                                                    (F.floor(F.col("id") / rows_per_quarter) * 3).cast("int"))).cast("timestamp"))
+    if action_type == "lease":
+        df = df.withColumn("RentP50", F.rand(1) * 1000 + 400) \
+               .withColumn("RentsNumber", F.floor(F.rand(2) * 50 + 1).cast("double"))
+        columns = LEASE_COLUMNS
+    else:
+        df = df.withColumn("PriceP50", F.rand(3) * 400000 + 100000) \
+               .withColumn("ParcelsNumber", F.floor(F.rand(4) * 50 + 1).cast("double"))
+        columns = TRANSACTION_COLUMNS
+    df.select(*columns).write.mode("overwrite").parquet(path)
+
+def shuffle_bytes(spark) -> int:
+    '''Shuffle bytes written by all the stages of this application so far, from the Spark UI REST API'''
+    url = f"{spark.sparkContext.uiWebUrl}/api/v1/applications/{spark.sparkContext.applicationId}/stages"
+    with urllib.request.urlopen(url) as response:
+        stages = json.load(response)
+    return sum(stage.get("shuffleWriteBytes", 0) for stage in stages)
+
+def run(spark, leases_path: str, transactions_path: str, output_path: str, join_plan: str, broadcast: str) -> dict:
+    '''Run one plan end to end (read, aggregate, join, write) and measure it'''
+    # Give the UI listener time to account for the previous run
+    time.sleep(2)
+    shuffle_before = shuffle_bytes(spark)
+    start = time.perf_counter()
+    result = price_to_rent_ratio(read_input(spark, leases_path, LEASE_COLUMNS),
+                                 read_input(spark, transactions_path, TRANSACTION_COLUMNS),
+                                 join_plan=join_plan, broadcast=broadcast)
+    result.write.mode("overwrite").parquet(output_path)
+    wall_time = time.perf_counter() - start
+    time.sleep(2)
+    return {"join_plan": join_plan,
+            "broadcast": broadcast,
+            "wall_time_s": round(wall_time, 2),
+            "shuffle_bytes": shuffle_bytes(spark) - shuffle_before}
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--scale', choices=SCALES, default="municipality")
+    parser.add_argument('--spark_master', default="local[*]")
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--output', default=None, help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    nis_codes, rows_per_code = SCALES[args.scale]
+    with tempfile.TemporaryDirectory() as folder:
+        leases_path = os.path.join(folder, "leases")
+        transactions_path = os.path.join(folder, "transactions")
+        spark = SPARK.start(args.spark_master)
+        generate(spark, leases_path, "lease", nis_codes, rows_per_code)
+        generate(spark, transactions_path, "transaction", nis_codes, rows_per_code)
+        SPARK.start(args.spark_master, input_bytes=input_size([leases_path, transactions_path]))
+
+        results = []
+        for join_plan, broadcast in PLANS:
+            for _ in range(args.repeat):
+                result = run(spark, leases_path, transactions_path, os.path.join(folder, "output"), join_plan, broadcast)
+                result["scale"] = args.scale
+                print(result)
+                results.append(result)
+        SPARK.stop()
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2)
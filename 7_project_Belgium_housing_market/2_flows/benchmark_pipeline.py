@@ -0,0 +1,223 @@
+'''Benchmark the stages of the Belgium housing pipeline on synthetic data, offline.
+
+Generates ;-separated Transactions and Rents CSV files with the columns of the opendata.fin.belgium.be
+files, at the size of one quarter of a given geographical level, and times every stage on them:
+load_raw_clean_save, convert_csv_to_parquet, fetch, write_local, transform and pyspark_transform.
+Every stage runs in a fresh process, so its peak memory is not hidden by the stages before it.
+The results are written as JSON; pass the JSON of an earlier commit with --compare to see the change.
+
+Run from the 2_flows folder, for example:
+    python benchmark_pipeline.py --scale municipality --output bench_municipality.json
+    python benchmark_pipeline.py --scale statistical_unit --skip_spark --compare bench_before.json
+'''
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "0_common"))
+from schemas import RENTS_DTYPES, TRANSACTIONS_DTYPES
+
+# Number of NIS codes of every level
+SCALES = {"national": 1,
+          "regional": 3,
+          "provincial": 11,
+          "arrondissement": 43,
+          "municipality": 581,
+          "statistical_unit": 19781}
+TRANSACTION_TYPES = ['CESSION', 'COMMUNAUTE', 'DONATIMMEUB', 'OTHER', 'PARTAGE', 'SUCCNALAT',
+                     'VENTEIMMEUB', 'VENTEPUBIMMEUB', 'TOTAL']
+PARCEL_NATURES = ['1', '2', '3', '200', '203', '204', '240', 'I', 'II', 'TOTAL']
+REGISTRATION_TYPES = ['NEW', 'RENEWAL', 'TOTAL']
+PARTY_TYPES = ['PP', 'PM', 'TOTAL']
+# Share of the rows of the raw files with a missing measure, which the cleaning drops
+NAN_SHARE = 0.3
+DATE_ENCODING = "20160331"
+
+STAGES = ["load_raw_clean_save", "convert_csv_to_parquet", "fetch", "write_local", "transform", "pyspark_transform"]
+
+def generate_csv(path: str, family: str, nis_codes: int, seed: int = 0) -> int:
+    '''Write a raw ;-separated CSV file of a dataset family with one row per NIS code and category combination'''
+    rng = np.random.default_rng(seed)
+    if family == 'Transactions':
+        categories = {'TransactionType': TRANSACTION_TYPES, 'ParcelNature': PARCEL_NATURES}
+        dtypes = dict(TRANSACTIONS_DTYPES)
+        if nis_codes < SCALES["statistical_unit"]:
+            # Only the statistical unit files have the Fictious column
+            del dtypes['Fictious']
+    else:
+        categories = {'RegistrationType': REGISTRATION_TYPES, 'LessorType': PARTY_TYPES, 'TakerType': PARTY_TYPES}
+        dtypes = dict(RENTS_DTYPES)
+    combinations = pd.MultiIndex.from_product(list(categories.values()), names=list(categories)).to_frame(index=False)
+    codes = pd.Series([f"{11001 + i}" for i in range(nis_codes)], name='NISCode')
+    df = codes.to_frame().merge(combinations, how='cross')
+
+    rows = len(df)
+    measures = []
+    for col, dtype in dtypes.items():
+        if col in df.columns:
+            continue
+        if col.startswith('Name'):
+            df[col] = 'Commune ' + df['NISCode']
+        elif col == 'Fictious':
+            df[col] = '0'
+        else:
+            df[col] = rng.lognormal(mean=10, sigma=1, size=rows).round(1)
+            measures.append(col)
+    # Blank one measure of the incomplete rows
+    incomplete = np.flatnonzero(rng.random(rows) < NAN_SHARE)
+    blanked = rng.integers(0, len(measures), size=len(incomplete))
+    for i, col in enumerate(measures):
+        df.loc[incomplete[blanked == i], col] = np.nan
+    df[list(dtypes)].to_csv(path, sep=';', index=False)
+    return rows
+
+def measure(stage: str, run, rows: int, size_bytes: int) -> dict:
+    '''Time a stage and report its throughput and the peak memory of this (fresh) process'''
+    from instrumentation import peak_rss_mb
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    return {"stage": stage,
+            "rows": rows,
+            "mb": round(size_bytes / 2**20, 2),
+            "seconds": round(seconds, 3),
+            "rows_per_s": round(rows / max(seconds, 1e-9)),
+            "mb_per_s": round(size_bytes / 2**20 / max(seconds, 1e-9), 2),
+            "peak_rss_mb": round(peak_rss_mb()),
+            "baseline_rss_mb": round(baseline)}
+
+def run_stage(stage: str, folder: str, spark_master: str) -> list[dict]:
+    '''Run one stage on the generated files (in a worker process) and return one measurement per dataset family'''
+    import pyarrow.parquet as pq
+    import etl_web_to_gcs
+    results = []
+    for family in ['Transactions', 'Rents']:
+        raw = os.path.join(folder, f"raw{family}.csv")
+        cleaned = os.path.join(folder, f"clean{family}.csv")
+        converted = os.path.join(folder, f"converted{family}.parquet")
+        rows = sum(1 for _ in open(raw)) - 1
+        if stage == "load_raw_clean_save":
+            if os.path.exists(cleaned):
+                os.remove(cleaned)
+            run = lambda: etl_web_to_gcs.load_raw_clean_save.fn(load_from=raw, save_to=cleaned)
+            size = os.path.getsize(raw)
+        elif stage == "convert_csv_to_parquet":
+            run = lambda: etl_web_to_gcs.convert_csv_to_parquet.fn(load_from=raw, save_to=converted)
+            size = os.path.getsize(raw)
+        elif stage == "fetch":
+            run = lambda: etl_web_to_gcs.fetch.fn(raw)
+            size = os.path.getsize(raw)
+        elif stage == "write_local":
+            df = etl_web_to_gcs.clean.fn(etl_web_to_gcs.fetch.fn(raw))
+            rows = len(df)
+            run = lambda: etl_web_to_gcs.write_local.fn(df, os.path.join(folder, f"local{family}.parquet"))
+            size = int(df.memory_usage(deep=True).sum())
+        elif stage == "transform":
+            from etl_gcs_to_bq import transform
+            table = pq.read_table(converted)
+            rows = table.num_rows
+            run = lambda: transform.fn(table, DATE_ENCODING)
+            size = table.nbytes
+        else:
+            # Both inputs go through one join, measured once
+            results.append(run_pyspark_transform(folder, spark_master))
+            break
+        results.append(dict(measure(stage, run, rows, size), family=family))
+    return results
+
+def run_pyspark_transform(folder: str, spark_master: str) -> dict:
+    '''Join the converted Rents and Transactions files of four quarters with pyspark_transform'''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from etl_bq_pyspark_bq import input_size, pyspark_transform
+    from spark_session import SPARK
+    from transfer import write_parquet
+
+    inputs = []
+    for family in ['Rents', 'Transactions']:
+        table = pq.read_table(os.path.join(folder, f"converted{family}.parquet"))
+        quarters = []
+        for date in pd.to_datetime(["2016-03-31", "2016-06-30", "2016-09-30", "2016-12-31"]):
+            quarters.append(table.append_column('Date', pa.array([date] * table.num_rows, pa.timestamp('us'))))
+        path = os.path.join(folder, f"spark{family}.parquet")
+        write_parquet(pa.concat_tables(quarters), path)
+        inputs.append(path)
+    rows = sum(pq.ParquetFile(path).metadata.num_rows for path in inputs)
+
+    SPARK.start(spark_master, input_bytes=input_size(inputs))
+    try:
+        result = measure("pyspark_transform",
+                         lambda: pyspark_transform.fn(inputs[0], inputs[1], os.path.join(folder, "joined")),
+                         rows, sum(os.path.getsize(path) for path in inputs))
+    finally:
+        SPARK.stop()
+    return dict(result, family="Rents+Transactions")
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: list[dict], previous_path: str) -> None:
+    '''Print the speed of every stage relative to an earlier results file'''
+    with open(previous_path) as fd:
+        previous = {(r["stage"], r["family"]): r for r in json.load(fd)["results"]}
+    for result in results:
+        before = previous.get((result["stage"], result["family"]))
+        if before is None:
+            continue
+        speedup = before["seconds"] / max(result["seconds"], 1e-9)
+        print(f"{result['stage']:>24} {result['family']:>18}: {before['seconds']:8.3f}s -> {result['seconds']:8.3f}s "
+              f"({speedup:.2f}x), peak RSS {before['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--scale', choices=SCALES, default="municipality")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--skip_spark', action='store_true')
+    parser.add_argument('--spark_master', default="local[*]")
+    parser.add_argument('--output', default=None, help="optional JSON file for the results")
+    parser.add_argument('--compare', default=None, help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    stages = [stage for stage in args.stages if not (args.skip_spark and stage == "pyspark_transform")]
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        # Generate in a worker as well: on Linux a new process inherits the peak memory of the process it was forked from
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            for seed, family in enumerate(['Transactions', 'Rents']):
+                rows = executor.submit(generate_csv, os.path.join(folder, f"raw{family}.csv"), family, SCALES[args.scale], seed).result()
+                print(f"Generated {rows} {family} rows at {args.scale} scale")
+        # The later stages read what convert_csv_to_parquet writes
+        if any(stage in stages for stage in ["transform", "pyspark_transform"]) and "convert_csv_to_parquet" not in stages:
+            stages.insert(0, "convert_csv_to_parquet")
+        for stage in sorted(stages, key=STAGES.index):
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                for result in executor.submit(run_stage, stage, folder, args.spark_master).result():
+                    result["scale"] = args.scale
+                    print(result)
+                    results.append(result)
+
+    report = {"commit": git_commit(),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "cpu_count": os.cpu_count(),
+              "results": results}
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2)
+    if args.compare:
+        compare(results, args.compare)
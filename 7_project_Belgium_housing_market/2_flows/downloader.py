@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CHUNK_SIZE = 4 * 2**20  # 4 MB
+
+_session = None
+_session_lock = threading.Lock()
+
+class DownloadError(Exception):
+    '''The file could not be downloaded completely or failed verification'''
+
+def get_session(pool_size: int = 8) -> requests.Session:
+    '''Shared keep-alive session, so parallel downloads reuse pooled connections'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def sha256sum(path: Path, chunk_size: int = CHUNK_SIZE) -> str:
+    '''SHA-256 of a local file'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def validator(headers) -> str:
+    '''The If-Range validator of a response: its strong ETag, else its Last-Modified date'''
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+def remote_metadata(url: str, session: requests.Session = None, timeout: float = 60) -> dict:
+    '''Size and validator of a remote file, from a HEAD request'''
+    session = session or get_session()
+    r = session.head(url, allow_redirects=True, timeout=timeout)
+    if not r.ok:
+        raise DownloadError(f"HEAD request for url {url} was not successful: HTTP {r.status_code}")
+    content_length = r.headers.get('Content-Length')
+    return {'size': int(content_length) if content_length is not None else None,
+            'etag': r.headers.get('ETag'),
+            'validator': validator(r.headers)}
+
+def download(url: str, save_path: Path, chunk_size: int = CHUNK_SIZE, expected_size: int = None,
+             expected_sha256: str = None, session: requests.Session = None, timeout: float = 60) -> dict:
+    '''Download url to save_path and return the transfer metrics.
+
+    Data is written to save_path + ".part" first, and the ETag or Last-Modified date of the response
+    to save_path + ".part.validator". If both are left over from an interrupted download, only the
+    missing bytes are requested with an HTTP Range header, conditional on that validator (If-Range):
+    if the remote file changed, the server sends all of it and the download starts over. The file is
+    moved to save_path once its size (and checksum, if given) is verified; otherwise DownloadError is raised.
+    '''
+    session = session or get_session()
+    partial_path = Path(f"{save_path}.part")
+    validator_path = Path(f"{save_path}.part.validator")
+    offset = partial_path.stat().st_size if partial_path.exists() else 0
+    if offset and not validator_path.exists():
+        # The partial bytes cannot be matched to the remote file without a validator
+        offset = 0
+    headers = {'Range': f"bytes={offset}-", 'If-Range': validator_path.read_text()} if offset else {}
+
+    start = time.perf_counter()
+    with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        if r.status_code == 416:
+            # The partial file is already complete (or does not match the remote file any more)
+            r.close()
+            os.remove(partial_path)
+            validator_path.unlink(missing_ok=True)
+            return download(url, save_path, chunk_size, expected_size, expected_sha256, session, timeout)
+        if not r.ok:
+            raise DownloadError(f"Request for url {url} was not successful: HTTP {r.status_code}")
+        if r.status_code != 206:
+            # The server ignored the Range header or the remote file changed, start from scratch
+            offset = 0
+            response_validator = validator(r.headers)
+            if response_validator:
+                validator_path.write_text(response_validator)
+            else:
+                validator_path.unlink(missing_ok=True)
+        content_length = r.headers.get('Content-Length')
+        total_size = offset + int(content_length) if content_length is not None else None
+        etag = r.headers.get('ETag')
+
+        with open(partial_path, 'ab' if offset else 'wb') as fd:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                fd.write(chunk)
+    elapsed = time.perf_counter() - start
+
+    size = partial_path.stat().st_size
+    expected_size = expected_size or total_size
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            # Not resumable: the partial file is larger than the remote one
+            os.remove(partial_path)
+            validator_path.unlink(missing_ok=True)
+        raise DownloadError(f"Download of {url} is incomplete: {size} of {expected_size} bytes")
+    checksum = sha256sum(partial_path)
+    if expected_sha256 is not None and checksum != expected_sha256:
+        os.remove(partial_path)
+        validator_path.unlink(missing_ok=True)
+        raise DownloadError(f"Checksum mismatch for {url}: got {checksum}, expected {expected_sha256}")
+    os.replace(partial_path, save_path)
+    validator_path.unlink(missing_ok=True)
+
+    downloaded = size - offset
+    return {'url': url,
+            'path': f"{save_path}",
+            'size': size,
+            'downloaded_bytes': downloaded,
+            'resumed_from': offset,
+            'seconds': elapsed,
+            'mb_per_s': downloaded / 2**20 / max(elapsed, 1e-9),
+            'sha256': checksum,
+            'etag': etag}
@@ -1,67 +1,121 @@
 import pyspark
-from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
 from pyspark.sql import types
 from pyspark.sql import functions as F
 from prefect import flow, task
-from prefect_gcp import GcpCredentials
-import pandas as pd
-import pandas_gbq as pdbq
+import os
+from pathlib import Path
+from functools import reduce
+from typing import NamedTuple
+import sys
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(str(Path(__file__).resolve().parents[2] / "0_common"))
+from spark_session import SPARK
+from instrumentation import DEBUG, instrumented
+from manifest import Manifest
+from partitions import PartitionIndex, spark_read_partitions
+from transfer import LOCAL_PATH, STAGING_PATH, get_backend, parquet_files
 
 
-@task(log_prints=True, retries=3)
-def get_bq_dataframe(filename:str = None, action_type:str = None) -> pd.DataFrame:
-    
-    # Credentials block
-    gcp_credentials_block = GcpCredentials.load("belgium-housing-gcp-cred")
-  
-    # Create the table access string
-    table_string = ''
+LEASE_COLUMNS = ["NISCode", "NameFre", "NameDut", "NameGer", "RentP50", "Date", "RentsNumber"]
+TRANSACTION_COLUMNS = ["NISCode", "NameFre", "NameDut", "NameGer", "PriceP50", "Date", "ParcelsNumber"]
+
+# Manifest action type under which the source fingerprints of the ratio tables are kept
+RATIO_ACTION_TYPE = "transactions_rents"
+BROADCAST_THRESHOLD_BYTES = 32 * 2**20  # 32 MB of parquet
+
+class Partitions(NamedTuple):
+    '''Quarters of a file in the local hive partitioned dataset written by etl_web_to_gcs, read without an export'''
+    root: str
+    file: str
+    dates: list[str] = None
+
+    def paths(self) -> list[str]:
+        return PartitionIndex(self.root).paths(files=[self.file], dates=self.dates)
+
+def input_size(paths: list) -> int:
+    '''Total size in bytes of the exported parquet files or of the selected partitions'''
+    files = [file for path in paths for file in (path.paths() if isinstance(path, Partitions) else parquet_files(path))]
+    return sum(os.path.getsize(file) for file in files)
+
+def broadcast_side(leases_bytes: int, transactions_bytes: int, threshold: int = BROADCAST_THRESHOLD_BYTES) -> str:
+    '''Side of the join to broadcast ("leases" or "transactions"), or None if neither side is small'''
+    if min(leases_bytes, transactions_bytes) > threshold:
+        return None
+    return "leases" if leases_bytes <= transactions_bytes else "transactions"
+
+def table_name(filename: str, action_type: str) -> str:
+    '''BigQuery table with all the quarters of a lease or transaction file'''
     if action_type == "lease":
-        table_string = f'belgium_housing_leases.{filename}Rents_all'
+        return f'belgium_housing_leases.{filename}Rents_all'
     elif action_type == "transaction":
-        table_string = f'belgium_housing_transactions.{filename}Transactions_all'
-    
-    # Download the dataframe
-    df = pdbq.read_gbq(query_or_table=table_string,
-                        project_id='belgium-housing-market',
-                        credentials=gcp_credentials_block.get_credentials_from_service_account())
+        return f'belgium_housing_transactions.{filename}Transactions_all'
+
+@task(log_prints=True, retries=3)
+@instrumented()
+def export_bq_table(filename:str = None, action_type:str = None, backend:str = "bigquery", dates:list[str] = None) -> Path:
+    '''Download a BigQuery table, or only the rows of the given dates, as a local parquet file'''
+    table_string = table_name(filename, action_type)
+    path = Path(os.path.join(STAGING_PATH, f"{table_string}.parquet"))
+    get_backend(backend).export_table(table_string, path, dates)
+    print(f"Exported {table_string} to {path}")
+    return path
 
-    # Remove duplicates
-    df = df.drop_duplicates()
+def select_partitions(filename:str = None, action_type:str = None, dates:list[str] = None) -> Partitions:
+    '''The partitions of a lease or transaction file, or only the ones of the given dates, in the local dataset'''
+    root = os.path.join(LOCAL_PATH, 'data', f"{action_type}s")
+    file = f"{filename}Rents" if action_type == "lease" else f"{filename}Transactions"
+    return Partitions(root, file, [date.replace('-', '') for date in dates] if dates is not None else None)
 
-    return df
+def get_input(filename:str, action_type:str, source:str, backend:str, dates:list[str] = None):
+    '''Input of a lease or transaction file: a BigQuery export ("bigquery") or the local partitions ("partitions")'''
+    if source == "partitions":
+        return select_partitions(filename, action_type, dates)
+    return export_bq_table(filename, action_type, backend, dates)
 
 @task(log_prints=True, retries=3)
-def pyspark_transform(leases_df:pd.DataFrame = None, transactions_df:pd.DataFrame = None, spark_master:str = "local[*]", verbose:bool = False) -> pd.DataFrame:
-    
-    #Create PySpark SparkSession
-    spark = SparkSession.builder \
-        .master(spark_master) \
-        .appName("belgian_housing_buy_lease") \
-        .getOrCreate()
-    
-    #Create PySpark DataFrame from Pandas
-    leases_psdf = spark.createDataFrame(leases_df) 
-    transactions_psdf = spark.createDataFrame(transactions_df)
-    
-    # Print schemas
-    if verbose:
-        leases_psdf.printSchema()
-        transactions_psdf.printSchema()
+def changed_dates(filename:str = None, backend:str = "bigquery") -> tuple:
+    '''Dates whose leases or transactions rows changed since the ratio table was last computed, and the new fingerprints'''
+    warehouse = get_backend(backend)
+    leases = warehouse.date_fingerprints(table_name(filename, "lease"))
+    transactions = warehouse.date_fingerprints(table_name(filename, "transaction"))
+    fingerprints = {date: f"{leases.get(date)}|{transactions.get(date)}" for date in set(leases) | set(transactions)}
+    stored = {date: entry['fingerprint'] for date, entry in Manifest().entries(RATIO_ACTION_TYPE, filename).items()}
+    # A date that disappeared from the sources also counts as changed, so its rows get removed
+    dates = sorted(date for date in set(fingerprints) | set(stored) if fingerprints.get(date) != stored.get(date))
+    return dates, fingerprints
 
-    # Select certain columns
-    leases_psdf = leases_psdf.select("NISCode", "NameFre", "NameDut", "NameGer", "RentP50", "Date", "RentsNumber")
-    transactions_psdf = transactions_psdf.select("NISCode", "NameFre", "NameDut", "NameGer", "PriceP50", "Date", "ParcelsNumber")
+@task(log_prints=True)
+def record_fingerprints(filename:str = None, dates:list[str] = None, fingerprints:dict = None) -> None:
+    '''Remember which source rows the ratio table of the given dates was computed from'''
+    manifest = Manifest()
+    for date in dates:
+        manifest.update(RATIO_ACTION_TYPE, filename, date, fingerprint=fingerprints.get(date))
 
-    # Print schemas
-    if verbose:
-        leases_psdf.printSchema()
-        transactions_psdf.printSchema()
+def read_input(spark, path, columns: list[str]) -> DataFrame:
+    '''Read an exported table or a selection of partitions, remove duplicates and keep the given columns'''
+    if isinstance(path, Partitions):
+        # Only the selected partitions are read; their Date is the quarter end of the year and quarter keys
+        psdf = spark_read_partitions(spark, path.root, files=[path.file], dates=path.dates) \
+            .withColumn("Date", F.expr("CAST(make_date(year, quarter * 3, IF(quarter IN (1, 4), 31, 30)) AS TIMESTAMP)"))
+    else:
+        psdf = spark.read.parquet(f"{path}")
+    return psdf.dropDuplicates().select(*columns)
+
+def price_to_rent_ratio(leases_psdf: DataFrame, transactions_psdf: DataFrame, keys: list[str] = ["NISCode", "Date"],
+                        join_plan: str = "copartitioned", broadcast: str = None) -> DataFrame:
+    '''Join the mean rents and prices per area and quarter and add their ratio.
+
+    join_plan "sort" is the original plan: a sort-merge join followed by a global sort, which costs an
+    extra range-partitioning shuffle. With "copartitioned" both aggregates come out of their groupBy
+    hash-partitioned on the same keys, so the join reuses that partitioning and the rows are only
+    sorted within partitions. broadcast ("leases" or "transactions") broadcasts that aggregate instead.
+    '''
 
     # Means
     leases_psdf = \
     leases_psdf \
-        .groupBy("NISCode", "Date") \
+        .groupBy(*keys) \
         .agg(F.avg("RentP50").alias("RentP50"), \
              F.sum("RentsNumber").alias("RentsNumber"),\
              F.first("NameFre").alias("NameFre")) \
@@ -71,7 +125,7 @@ def pyspark_transform(leases_df:pd.DataFrame = None, transactions_df:pd.DataFram
 
     transactions_psdf = \
         transactions_psdf \
-            .groupBy("NISCode", "Date") \
+            .groupBy(*keys) \
             .agg(F.avg("PriceP50").alias("PriceP50"), \
                  F.sum("ParcelsNumber").alias("ParcelsNumber"),\
                  F.first("NameDut").alias("NameDut"),\
@@ -80,57 +134,172 @@ def pyspark_transform(leases_df:pd.DataFrame = None, transactions_df:pd.DataFram
         #.sort("Date") \
         #.show(truncate=False)
     
+    if broadcast == "leases":
+        leases_psdf = F.broadcast(leases_psdf)
+    elif broadcast == "transactions":
+        transactions_psdf = F.broadcast(transactions_psdf)
+
     # PySpark join multiple columns
     transactions_and_leases_psdf = \
         leases_psdf \
-            .join(transactions_psdf, ["NISCode","Date"],"inner") \
-            .sort("NISCode", "Date") \
-            #.show()
+            .join(transactions_psdf, keys, "inner")
+    if join_plan == "sort":
+        transactions_and_leases_psdf = transactions_and_leases_psdf.sort(*keys)
+    else:
+        transactions_and_leases_psdf = transactions_and_leases_psdf.sortWithinPartitions(*keys)
     
     # Add column ratio price/rent
-    transactions_and_leases_psdf = transactions_and_leases_psdf.withColumn('PriceToRentRatio',
+    return transactions_and_leases_psdf.withColumn('PriceToRentRatio',
                        transactions_and_leases_psdf["PriceP50"] / transactions_and_leases_psdf["RentP50"])
+
+@task(log_prints=True, retries=3)
+# The output folder of an earlier run is not read
+@instrumented(read_from=['leases_path', 'transactions_path'])
+def pyspark_transform(leases_path:Path = None, transactions_path:Path = None, output_path:Path = None, verbose:bool = DEBUG,
+                      join_plan:str = "copartitioned") -> Path:
+    
+    # Shared session of this flow run
+    spark = SPARK.session()
+    
+    # Create PySpark DataFrames from the parquet files
+    leases_psdf = read_input(spark, leases_path, LEASE_COLUMNS)
+    transactions_psdf = read_input(spark, transactions_path, TRANSACTION_COLUMNS)
+
+    # Print schemas
+    if verbose:
+        leases_psdf.printSchema()
+        transactions_psdf.printSchema()
+
+    broadcast = broadcast_side(input_size([leases_path]), input_size([transactions_path])) if join_plan != "sort" else None
+    transactions_and_leases_psdf = price_to_rent_ratio(leases_psdf, transactions_psdf, join_plan=join_plan, broadcast=broadcast)
     
     if verbose:
         transactions_and_leases_psdf.show()
 
-    # PySpark to Pandas DF
-    transactions_and_leases_df = transactions_and_leases_psdf.toPandas()
+    # Write the result as parquet files; nothing is collected on the driver
+    transactions_and_leases_psdf.write.mode("overwrite").parquet(f"{output_path}")
 
     # Return result
-    return transactions_and_leases_df
+    return output_path
 
 @task(log_prints=True, retries=3)
-def upload_df_to_bq(df: pd.DataFrame = None, filename:str = None) -> None:
-    
-    # Get GCP credentials block
-    gcp_credentials_block = GcpCredentials.load("belgium-housing-gcp-cred")
+# The output folder of an earlier run is not read
+@instrumented(read_from=[])
+def pyspark_transform_levels(inputs:dict = None, output_path:Path = None, verbose:bool = DEBUG,
+                             join_plan:str = "copartitioned") -> dict:
+    '''Compute the ratio table of every regional level in one Spark job.
+
+    inputs maps every level (file name) to its exported (leases, transactions) parquet files. The levels are
+    stacked with a Level column, so all of them go through a single aggregation and join, and the
+    result is written partitioned by level.
+    '''
+    spark = SPARK.session()
+
+    leases = [read_input(spark, leases_path, LEASE_COLUMNS).withColumn("Level", F.lit(level))
+              for level, (leases_path, _) in inputs.items()]
+    transactions = [read_input(spark, transactions_path, TRANSACTION_COLUMNS).withColumn("Level", F.lit(level))
+                    for level, (_, transactions_path) in inputs.items()]
+    # The deduplicated inputs are cached once and shared by the row count below and the aggregations
+    leases_psdf = reduce(DataFrame.unionByName, leases).cache()
+    transactions_psdf = reduce(DataFrame.unionByName, transactions).cache()
+    print(f"Input rows: {leases_psdf.count()} leases, {transactions_psdf.count()} transactions over {len(inputs)} levels")
+
+    broadcast = broadcast_side(input_size([leases_path for leases_path, _ in inputs.values()]),
+                               input_size([transactions_path for _, transactions_path in inputs.values()])) if join_plan != "sort" else None
+    transactions_and_leases_psdf = price_to_rent_ratio(leases_psdf, transactions_psdf, ["Level", "NISCode", "Date"],
+                                                       join_plan=join_plan, broadcast=broadcast)
+    if verbose:
+        transactions_and_leases_psdf.show()
+
+    transactions_and_leases_psdf.write.mode("overwrite").partitionBy("Level").parquet(f"{output_path}")
+    leases_psdf.unpersist()
+    transactions_psdf.unpersist()
+
+    return {level: Path(os.path.join(output_path, f"Level={level}")) for level in inputs}
+
+@task(log_prints=True, retries=3)
+@instrumented()
+def upload_parquet_to_bq(path: Path = None, filename:str = None, backend:str = "bigquery", dates:list[str] = None) -> int:
     
-    # Upload dataframe to BQ
-    df.to_gbq(
-            destination_table=f"belgium_housing_transactions_rents.{filename}",
-            project_id="belgium-housing-market",
-            credentials=gcp_credentials_block.get_credentials_from_service_account(),
-            chunksize=500000,
-            if_exists="replace")
+    table_string = f"belgium_housing_transactions_rents.{filename}"
+    if dates is None:
+        # Replace the table with a parquet load job
+        rows = get_backend(backend).load_parquet(path, table_string, write_disposition="WRITE_TRUNCATE")
+    else:
+        # Replace only the rows of the recomputed dates
+        rows = get_backend(backend).replace_dates(path, table_string, dates)
+    print(f"Loaded {rows} rows into {table_string}")
+    return rows
+
+def find_changes(files:list[str], backend:str, incremental:bool) -> dict:
+    '''Dates to recompute and source fingerprints per file; (None, None) recomputes the whole history'''
+    changes = {}
+    for filename in files:
+        if not incremental:
+            changes[filename] = (None, None)
+            continue
+        dates, fingerprints = changed_dates(filename, backend)
+        if dates:
+            print(f"{filename}: recomputing {len(dates)} new or changed quarter(s): {dates}")
+            changes[filename] = (dates, fingerprints)
+        else:
+            print(f"{filename}: no new or changed quarters.")
+    return changes
 
 @flow(log_prints=True)
-def etl_bq_pyspark_bq(filename:str = None, spark_master:str = None) -> None:
+def etl_bq_pyspark_bq(filename:str = None, spark_master:str = None, backend:str = "bigquery", incremental:bool = True,
+                      source:str = "bigquery") -> None:
 
-    # Get dataframes from BQ
-    leases_df = get_bq_dataframe(filename, "lease")
-    transactions_df = get_bq_dataframe(filename, "transaction")
+    changes = find_changes([filename], backend, incremental)
+    if not changes:
+        return
+    dates, fingerprints = changes[filename]
 
-    # Transform and create a joint dataframe
-    transactions_and_leases_df = pyspark_transform(leases_df, transactions_df, spark_master)
+    # Get the tables from BQ as parquet files, or read the local partitions directly
+    leases_path = get_input(filename, "lease", source, backend, dates)
+    transactions_path = get_input(filename, "transaction", source, backend, dates)
 
-    # Upload Pandas df to BQ
-    upload_df_to_bq(transactions_and_leases_df, filename)   
+    # Transform and create a joint dataset
+    SPARK.start(spark_master, input_bytes=input_size([leases_path, transactions_path]))
+    try:
+        output_path = Path(os.path.join(STAGING_PATH, f"belgium_housing_transactions_rents.{filename}"))
+        output_path = pyspark_transform(leases_path, transactions_path, output_path)
+    finally:
+        SPARK.stop()
+
+    # Upload the parquet files to BQ
+    upload_parquet_to_bq(output_path, filename, backend, dates)
+    if dates is not None:
+        record_fingerprints(filename, dates, fingerprints)
 
 @flow(log_prints=True)
-def etl_bq_pyspark_bq_main(files:list[str] = None, spark_master:str = None) -> None:
-    for filename in files:
-        etl_bq_pyspark_bq(filename, spark_master)
+def etl_bq_pyspark_bq_main(files:list[str] = None, spark_master:str = None, backend:str = "bigquery", incremental:bool = True,
+                           source:str = "bigquery") -> None:
+
+    # With incremental, only the quarters that are new or changed in the _all tables are recomputed
+    changes = find_changes(files, backend, incremental)
+    if not changes:
+        return
+
+    # Get the tables of all levels from BQ as parquet files. With source "partitions", the hive partitioned dataset
+    # written by etl_web_to_gcs on this machine is read directly, only the partitions of the changed quarters.
+    inputs = {filename: (get_input(filename, "lease", source, backend, dates), get_input(filename, "transaction", source, backend, dates))
+              for filename, (dates, _) in changes.items()}
+
+    # One session, sized to the whole input, runs all levels as one batched job
+    SPARK.start(spark_master, input_bytes=input_size([path for paths in inputs.values() for path in paths]))
+    try:
+        output_path = Path(os.path.join(STAGING_PATH, "belgium_housing_transactions_rents"))
+        outputs = pyspark_transform_levels(inputs, output_path)
+    finally:
+        SPARK.stop()
+
+    # Upload the parquet files of every level to BQ
+    for filename, path in outputs.items():
+        dates, fingerprints = changes[filename]
+        upload_parquet_to_bq(path, filename, backend, dates)
+        if dates is not None:
+            record_fingerprints(filename, dates, fingerprints)
 
 if __name__ == "__main__":
     '''
@@ -1,77 +1,133 @@
 from pathlib import Path
+from datetime import datetime
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from prefect import flow, task
 from prefect_gcp.cloud_storage import GcsBucket
+from google.api_core.exceptions import NotFound
 import os
-from prefect.tasks import task_input_hash
-from datetime import timedelta
-from prefect_gcp import GcpCredentials
+import sys
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(str(Path(__file__).resolve().parents[2] / "0_common"))
+from instrumentation import instrumented
+from manifest import Manifest
+from partitions import PartitionIndex, gcs_filesystem, partition_path, read_partitions
+from schemas import SCHEMAS, apply_filter_spec, arrow_filters, arrow_schema, dataset_family, filter_spec, pandas_dtypes, projected_columns
+from transfer import STAGING_PATH, concat_tables, get_backend, write_parquet
 
 LOCAL_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-@task(retries=3)
-def extract_from_gcs(action_type:str, file:str, year:int, month: int) -> Path:
-    """Download trip data from GCS"""
+def quarter_date_encoding(year:int, month:int) -> str:
     day = 31 if month in [3, 12] else 30
-    date_encoding = f"{year}{month:02}{day}"
+    return f"{year}{month:02}{day}"
 
-    gcs_path = f"{action_type}/{file}/{file}_{date_encoding}.csv"
-    gcs_block = GcsBucket.load("belgium-housing-gcs")
-    local_path = Path(os.path.join(*[LOCAL_PATH, 'data', 'temp']))
-    gcs_block.get_directory(
-        from_path=gcs_path,
-        local_path=local_path
-    )
+def read_legacy_csv(source, file:str) -> pa.Table:
+    """Typed table of a cleaned CSV uploaded before the hive partitioned layout, with the filter spec applied.
 
-    return Path(f"{local_path}/{gcs_path}")
+    The parquet files uploaded next to these CSV files were read with the wrong separator and hold a
+    single text column, so the CSV is the only usable artifact of those quarters.
+    """
+    family = dataset_family(file)
+    dtypes = SCHEMAS[family]
+    # Comma separated, with the pandas index as first column
+    df = apply_filter_spec(pd.read_csv(source, dtype=dtypes, usecols=lambda col: col in dtypes), filter_spec(family))
+    return pa.Table.from_pandas(df, schema=arrow_schema(family, df.columns), preserve_index=False)
 
-@task()
-def transform(action_type:str, path: Path) -> pd.DataFrame:
-    """Data cleaning"""
-    #df = pd.read_parquet(path)
-    df = pd.read_csv(path)
-    if action_type == "transactions":
-        df = df[df['ParcelNature'] == "200"] # Maison/house
-        df = df[df['TransactionType'] == "VENTEIMMEUB"] # Private direct sales
-    date = f"{path}".split('/')[-1].split('.')[0].split('_')[-1]
-    date = date[0:4] + '-' + date[4:6] + '-' + date[6:8]
-    df['Date'] = pd.Timestamp(date)
-    # TODO something
-    return df
+@task(retries=3)
+@instrumented()
+def extract_from_gcs(bucket, action_type:str, file:str, date_encoding:str) -> pa.Table:
+    """Read the typed parquet artifact of a quarter from GCS, with column projection and the row filters"""
+    gcs_path = partition_path(action_type, file, date_encoding)
+    try:
+        data = pa.BufferReader(bucket.blob(f"{gcs_path}").download_as_bytes())
+    except NotFound:
+        # Uploaded before the hive partitioned layout: only the CSV of the quarter holds typed columns
+        data = bucket.blob(f"{action_type}/{file}/{file}_{date_encoding}.csv").download_as_bytes()
+        return read_legacy_csv(pa.BufferReader(data), file)
+    # Only the declared columns kept by the filter spec go to the warehouse. The row filters are applied again
+    # because the artifacts uploaded before the spec was applied while converting are not filtered yet.
+    family = dataset_family(file)
+    spec = filter_spec(family)
+    columns = projected_columns(spec, pandas_dtypes(family, pq.read_schema(data).names))
+    return pq.read_table(data, columns=columns, filters=arrow_filters(spec))
+
+@task(retries=3)
+@instrumented()
+def extract_partitions(filesystem, root:str, file:str, date_encodings:list[str]) -> pa.Table:
+    """Read the indexed quarters of a file from the hive partitioned dataset in GCS, in one dataset scan"""
+    family = dataset_family(file)
+    spec = filter_spec(family)
+    filters = arrow_filters(spec)
+    table = read_partitions(root, files=[file], dates=date_encodings, filesystem=filesystem,
+                            columns=projected_columns(spec, list(pandas_dtypes(family))),
+                            filters=pq.filters_to_expression(filters) if filters else None)
+    # The Date derived from the partition keys stays, the keys themselves do not go to the warehouse
+    return table.drop(['file', 'year', 'quarter'])
 
 @task()
-def write_bq(action_type:str, file:str, df: pd.DataFrame) -> None:
-    """Write DataFrame to BigQuery"""
+@instrumented()
+def transform(table: pa.Table, date_encoding:str) -> pa.Table:
+    """Add the quarter date"""
+    date = datetime.strptime(date_encoding, "%Y%m%d")
+    return table.append_column('Date', pa.array([date] * table.num_rows, pa.timestamp('us')))
 
-    gcp_credentials_block = GcpCredentials.load("belgium-housing-gcp-cred")
-    df.to_gbq(
-        destination_table=f"belgium_housing_{action_type}.{file}_all",
-        project_id="belgium-housing-market",
-        credentials=gcp_credentials_block.get_credentials_from_service_account(),
-        chunksize=500000,
-        if_exists="append"
-    )
+@task(log_prints=True, retries=3)
+@instrumented()
+def write_bq(action_type:str, file:str, tables: list[pa.Table], backend:str = "bigquery") -> int:
+    """Append the quarters of a file to BigQuery with a single parquet load job"""
+    table_string = f"belgium_housing_{action_type}.{file}_all"
+    path = Path(os.path.join(STAGING_PATH, f"{table_string}.parquet"))
+    os.makedirs(STAGING_PATH, exist_ok=True)
+    write_parquet(concat_tables(tables), path)
+    rows = get_backend(backend).load_parquet(path, table_string, write_disposition="WRITE_APPEND")
+    os.remove(path)
+    print(f"Loaded {rows} rows of {len(tables)} quarter(s) into {table_string}")
+    return rows
 
 @flow()
-def etl_gcs_to_bq(action_type = None, file = None, years = None, months = None) -> int:
+def etl_gcs_to_bq(action_type = None, files = None, years = None, months = None, backend:str = "bigquery") -> int:
     """Main ETL flow to load data into BigQuery"""
+    manifest = Manifest()
+    # One storage client for all the files and quarters of this run
+    gcs_bucket = GcsBucket.load("belgium-housing-gcs")
+    bucket = gcs_bucket.get_bucket()
+    filesystem = gcs_filesystem(gcs_bucket.gcp_credentials)
+    # The bucket mirrors the local data folder, with the partition index of every action type
+    root = f"{gcs_bucket.bucket}/{action_type}"
+    index = PartitionIndex(root, filesystem)
     for file in files:
         if action_type == "leases" and "Transactions" in file:
             continue
         if action_type == "transactions" and "Rents" in file:
             continue
-        path = extract_from_gcs(action_type, file, years, months)
-        df = transform(action_type, path)
-        write_bq(action_type, file, df)
-        os.remove(path)
+        date_encodings = []
+        for year in years:
+            for month in months:
+                date_encoding = quarter_date_encoding(year, month)
+                entry = manifest.get(action_type, file, date_encoding)
+                if entry.get('bq_loaded') or entry.get('status') == 'missing':
+                    print(f"{file}_{date_encoding} is already done according to the manifest.")
+                    continue
+                date_encodings.append(date_encoding)
+        if not date_encodings:
+            continue
+        # The indexed quarters are read in a single scan, only the ones uploaded before the index one by one
+        indexed = [entry['date'] for entry in index.partitions(files=[file], dates=date_encodings)]
+        tables = [extract_partitions(filesystem, root, file, indexed)] if indexed else []
+        for date_encoding in date_encodings:
+            if date_encoding not in indexed:
+                table = extract_from_gcs(bucket, action_type, file, date_encoding)
+                tables.append(transform(table, date_encoding))
+        write_bq(action_type, file, tables, backend)
+        for date_encoding in date_encodings:
+            manifest.update(action_type, file, date_encoding, bq_loaded=1)
     return True
 
 @flow(log_prints=True)
-def etl_gcs_to_bq_main(action_types = None, files = None, years = None, months = None) -> None:
+def etl_gcs_to_bq_main(action_types = None, files = None, years = None, months = None, backend:str = "bigquery") -> None:
     for action_type in action_types:
-        for year in years:
-            for month in months:
-                etl_gcs_to_bq(action_type, files, year, month)
+        etl_gcs_to_bq(action_type, files, years, months, backend)
 
 if __name__ == "__main__":
     action_types = ["transactions", "leases"]
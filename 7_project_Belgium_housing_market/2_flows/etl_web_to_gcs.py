@@ -3,118 +3,209 @@ import pandas as pd
 from prefect import flow, task
 from prefect_gcp.cloud_storage import GcsBucket
 import os
-from prefect.tasks import task_input_hash
-from datetime import timedelta
-import requests
 from zipfile import ZipFile
-import shutil
-import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import time
+import threading
+import contextvars
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
+# The modules shared by the flows of all the chapters are in <repo>/0_common
+sys.path.append(str(Path(__file__).resolve().parents[2] / "0_common"))
+from artifact_cache import CACHE
+from instrumentation import DEBUG, instrumented, peak_rss_mb
+from downloader import CHUNK_SIZE, download, remote_metadata, sha256sum
+from manifest import Manifest
+from partitions import PartitionIndex, gcs_filesystem, partition_path
+from schemas import SCHEMAS, dataset_family, pandas_dtypes, arrow_schema, filter_spec, apply_filter_spec, projected_columns
 
 LOCAL_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-@task(log_prints=True)
-def download_url(url: str, save_path: Path, chunk_size: int=128) -> None:
-    '''Download file from URL'''
-    r = requests.get(url, stream=True)
-    if not r.ok:
-        print(f"Request for url {url} was not successful.")
-        return
-    with open(save_path, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            fd.write(chunk)
+class StageLimits:
+    '''Process-wide limits on how many quarters can download, convert or upload at the same time'''
+    def __init__(self, downloads: int = 2, conversions: int = 2, uploads: int = 4):
+        self.configure(downloads, conversions, uploads)
 
-@task(log_prints=True)
-def extract_zip(filepath: Path, output_folder: Path) -> None:
-    '''Extract a zip file to a destination folder'''
-    with ZipFile(filepath, 'r') as zObject:
-        # Extracting all the members of the zip 
-        # into a specific location.
-        zObject.extractall(path=output_folder)
+    def configure(self, downloads: int, conversions: int, uploads: int) -> None:
+        self.downloads = threading.BoundedSemaphore(max(1, downloads))
+        self.conversions = threading.BoundedSemaphore(max(1, conversions))
+        self.uploads = threading.BoundedSemaphore(max(1, uploads))
 
-@task(log_prints=True)
-def clean_zip_and_folder(filepath_zip: Path, extracted_zip_folder: Path) -> None:
-    '''Remove ZIP file and extracted folder'''
-    os.remove(filepath_zip)
-    shutil.rmtree(extracted_zip_folder)
+STAGE_LIMITS = StageLimits()
 
-@task(retries=3, cache_key_fn=task_input_hash, cache_expiration=timedelta(days=1))
+@task(log_prints=True, retries=3, retry_delay_seconds=10)
+@instrumented(read_from=[])
+def download_url(url: str, save_path: Path, chunk_size: int = CHUNK_SIZE, expected_size: int = None,
+                 expected_sha256: str = None) -> dict:
+    '''Download file from URL, resuming a partial download, and verify its size and checksum'''
+    with STAGE_LIMITS.downloads:
+        metrics = download(url, save_path, chunk_size=chunk_size, expected_size=expected_size,
+                           expected_sha256=expected_sha256)
+    print(f"Downloaded {url}: {metrics['downloaded_bytes'] / 2**20:.1f} MB in {metrics['seconds']:.1f}s "
+          f"({metrics['mb_per_s']:.1f} MB/s, resumed from byte {metrics['resumed_from']})")
+    return metrics
+
+def zip_members(filepath: Path) -> dict:
+    '''Map the file names in a ZIP archive to their member names'''
+    with ZipFile(filepath, 'r') as archive:
+        return {os.path.basename(name): name for name in archive.namelist() if not name.endswith('/')}
+
+@contextmanager
+def open_csv(load_from, zip_path: Path = None):
+    '''Open a CSV file, or a CSV member of a ZIP archive, as a binary stream'''
+    if zip_path is None:
+        with open(load_from, 'rb') as fd:
+            yield fd
+    else:
+        with ZipFile(zip_path, 'r') as archive, archive.open(load_from) as fd:
+            yield fd
+
+@task(retries=3)
+@instrumented()
 def fetch(dataset_file: Path) -> pd.DataFrame:
-    """Read housing data from web into pandas DataFrame"""
-    dtype_dict = {'NISCode': str,
-    'Fictious':             str,
-    'NameFre':             str,
-    'NameDut':             str,
-    'NameGer':             str,
-    'TransactionType':     str,
-    'ParcelNature':         str,
-    'ParcelsNumber':      np.float64,
-    'PriceP25':           np.float64,
-    'PriceP50':           np.float64,
-    'PriceP75':           np.float64,
-    'ParcelsAreaP25':     np.float64,
-    'ParcelsAreaP50':     np.float64,
-    'ParcelsAreaP75':     np.float64}
-    df = pd.read_csv(dataset_file,sep=';')
-    print(df.describe())
+    """Read housing data from web into pandas DataFrame, through the local artifact cache"""
+    dtypes = SCHEMAS[dataset_family(dataset_file)]
+    # The columns read are the ones of the dtypes, so the options key the cached DataFrame
+    read_options = {'sep': ';', 'dtype': dtypes}
+    df = CACHE.fetch(dataset_file, lambda: pd.read_csv(dataset_file, usecols=lambda col: col in dtypes, **read_options),
+                     read_options)
+    if DEBUG:
+        print(df.describe())
     return df
 
 @task(log_prints=True)
-def load_raw_clean_save(load_from = None, save_to = None, chunksize=10000):
-    """Load big CSV file by chunks, remove rows with nans and save the reduced file to CSV."""
-    header = True
-    for df in pd.read_csv(load_from,sep=';', chunksize=10000):
-        df = df.dropna()
-        # NISCode;NameFre;NameDut;NameGer;RegistrationType;LessorType;TakerType;RentsNumber;RentP25;RentP50;RentP75;ChargesP25;ChargesP50;ChargesP75;TotalRentP25;TotalRentP50;TotalRentP75
-        for str_col in ['NISCode', 'Fictious', 'NameFre', 'NameDut', 'NameGer', 'TransactionType', 'ParcelNature', 'RegistrationType', 'LessorType', 'TakerType']:
-            try:
-                df[str_col] = df[str_col].astype('str')
-            except:
-                #print(f"Column {str_col} is not present in this dataframe.")
-                pass
-        #df.to_parquet(dataset_file_parquet, compression="gzip", header=header, mode='a')
-        df.to_csv(save_to, header=header, mode='a')
-        header = False
+@instrumented()
+def load_raw_clean_save(load_from = None, save_to = None, chunksize=10000, spec: dict = None, save_unfiltered_to = None):
+    """Load big CSV file by chunks, remove rows with nans, apply the filter spec and save the reduced file to CSV.
+
+    spec defaults to the filter spec of the dataset family. With save_unfiltered_to, all the cleaned
+    rows, including the ones the spec drops, are also saved to that separate file.
+    """
+    family = dataset_family(load_from)
+    dtypes = SCHEMAS[family]
+    spec = filter_spec(family) if spec is None else spec
+    with STAGE_LIMITS.conversions:
+        header = True
+        for df in pd.read_csv(load_from, sep=';', chunksize=chunksize, dtype=dtypes, usecols=lambda col: col in dtypes):
+            df = df.dropna()
+            if save_unfiltered_to is not None:
+                df.to_csv(save_unfiltered_to, header=header, mode='a')
+            apply_filter_spec(df, spec).to_csv(save_to, header=header, mode='a')
+            header = False
 
 @task(log_prints=True)
+@instrumented()
+def convert_csv_to_parquet(load_from: Path = None, save_to: Path = None, save_csv_to: Path = None, chunksize: int = 10000,
+                           zip_path: Path = None, spec: dict = None, save_unfiltered_to: Path = None) -> int:
+    """Stream the raw CSV by chunks, remove rows with nans, apply the filter spec and write every chunk as a parquet row group.
+
+    Only one chunk is held in memory at a time. The cleaned CSV is optionally written in the same pass.
+    With zip_path, load_from is the name of a member of that ZIP archive and is decompressed on the fly.
+    spec defaults to the filter spec of the dataset family; with save_unfiltered_to, all the cleaned rows
+    are also written to that separate parquet file. Returns the number of rows kept by the spec.
+    """
+    with STAGE_LIMITS.conversions:
+        start = time.perf_counter()
+        family = dataset_family(load_from)
+        spec = filter_spec(family) if spec is None else spec
+        with open_csv(load_from, zip_path) as fd:
+            columns = pd.read_csv(fd, sep=';', nrows=0).columns
+        dtypes = pandas_dtypes(family, columns)
+        unfiltered_schema = arrow_schema(family, columns)
+        schema = arrow_schema(family, projected_columns(spec, columns))
+        # Write to temporary files first, so an interrupted run never leaves a truncated parquet file behind
+        partial_parquet = f"{save_to}.part"
+        partial_unfiltered = f"{save_unfiltered_to}.part"
+        if save_csv_to is not None and os.path.exists(save_csv_to):
+            os.remove(save_csv_to)
+
+        rows = 0
+        read_rows = 0
+        header = True
+        with ExitStack() as stack:
+            fd = stack.enter_context(open_csv(load_from, zip_path))
+            writer = stack.enter_context(pq.ParquetWriter(partial_parquet, schema, compression="gzip"))
+            unfiltered_writer = None
+            if save_unfiltered_to is not None:
+                unfiltered_writer = stack.enter_context(pq.ParquetWriter(partial_unfiltered, unfiltered_schema, compression="gzip"))
+            for df in pd.read_csv(fd, sep=';', chunksize=chunksize, dtype=dtypes, usecols=list(dtypes)):
+                df = df.dropna()
+                read_rows += len(df)
+                if unfiltered_writer is not None:
+                    unfiltered_writer.write_table(pa.Table.from_pandas(df, schema=unfiltered_schema, preserve_index=False))
+                df = apply_filter_spec(df, spec)
+                writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+                if save_csv_to is not None:
+                    df.to_csv(save_csv_to, header=header, mode='a')
+                    header = False
+                rows += len(df)
+        os.replace(partial_parquet, save_to)
+        if save_unfiltered_to is not None:
+            os.replace(partial_unfiltered, save_unfiltered_to)
+
+        elapsed = time.perf_counter() - start
+        print(f"Converted {load_from} to {save_to}: kept {rows} of {read_rows} rows in {elapsed:.1f}s "
+              f"({read_rows / max(elapsed, 1e-9):.0f} rows/s), peak RSS {peak_rss_mb():.0f} MB")
+    return rows
+
+@task(log_prints=True)
+@instrumented()
 def clean(df = pd.DataFrame) -> pd.DataFrame:
     """Fix dtype issues and remove lines with NAN"""
-    df = df.dropna()
-    for str_col in ['NISCode', 'Fictious', 'NameFre', 'NameDut', 'NameGer', 'TransactionType', 'ParcelNature']:
-        try:
-            df[str_col] = df[str_col].astype('str')
-        except:
-            print(f"Field {str_col} is not present in this dataframe.")
-
-    print(df.head(2))
-    print(f"columns: {df.dtypes}")
+    family = 'Rents' if 'RentsNumber' in df.columns else 'Transactions'
+    df = df.dropna().astype(pandas_dtypes(family, df.columns))
+
+    if DEBUG:
+        print(df.head(2))
+        print(f"columns: {df.dtypes}")
     print(f"rows: {len(df)}")
 
     return df
 
 @task(log_prints=True)
+@instrumented(read_from=[])
 def write_local(df: pd.DataFrame, dataset_file:Path) -> Path:
     """Write dataframe out as parquet file"""
 
     print(f"Saving local file to {dataset_file}...")
     #Path("../data").mkdir(parents=True, exist_ok=True)
-    df.to_parquet(dataset_file, compression="gzip")
+    with STAGE_LIMITS.conversions:
+        df.to_parquet(dataset_file, compression="gzip")
     print(f"Saved local file to {dataset_file}")
     return dataset_file
 
 @task()
+@instrumented()
 def write_gcs(path: Path) -> None:
     """Upload local parquet file to GCS"""
     gcp_cloud_storage_bucket_block = GcsBucket.load("belgium-housing-gcs")
-    path_gcs_list = f"{path}".split('/')
-    path_gcs = Path('/'.join([path_gcs_list[-3], path_gcs_list[-2], path_gcs_list[-1]]))
-    gcp_cloud_storage_bucket_block.upload_from_path(
-        from_path=f"{path}",
-        to_path=path_gcs
-    )
+    # The bucket mirrors the local data folder (<action_type>/...)
+    path_gcs = Path(os.path.relpath(path, os.path.join(LOCAL_PATH, 'data')))
+    with STAGE_LIMITS.uploads:
+        gcp_cloud_storage_bucket_block.upload_from_path(
+            from_path=f"{path}",
+            to_path=path_gcs
+        )
+
+@task(retries=3)
+@instrumented()
+def write_gcs_index(index: PartitionIndex, action_type: str) -> None:
+    """Merge the partitions of a local index into the index of the action type in GCS"""
+    gcs_bucket = GcsBucket.load("belgium-housing-gcs")
+    # Not a replacement: the index in GCS also has the partitions that other runs uploaded
+    remote = PartitionIndex(f"{gcs_bucket.bucket}/{action_type}", gcs_filesystem(gcs_bucket.gcp_credentials))
+    with STAGE_LIMITS.uploads:
+        remote.merge(index)
 
 @flow()
-def etl_web_to_gcs(action_type, files, year, month) -> None:
-    """The main ETL function"""
+def etl_web_to_gcs(action_type, files, year, month, keep_unfiltered: bool = False) -> None:
+    """The main ETL function.
+
+    The rows are filtered by the spec of the dataset family (see schemas.FILTER_SPECS) while converting.
+    With keep_unfiltered, all the cleaned rows are also uploaded, as the separate <file>_unfiltered partition.
+    """
 
     day = 31 if month in [3, 12] else 30
     date_encoding = f"{year}{month:02}{day}"
@@ -126,71 +217,132 @@ def etl_web_to_gcs(action_type, files, year, month) -> None:
 
     dataset_url = f"{base_url}_{date_encoding}_csv_NA_01000.zip"
     base_output_folder = Path(os.path.join(*[LOCAL_PATH, 'data', action_type]))
-    filepath_zip = Path(os.path.join(base_output_folder, f"{date_encoding}.zip"))
-    folder_extracted_zip = Path(os.path.join(base_output_folder, f"{date_encoding}"))
-
+    # The ZIP has a fixed per-quarter path, so a rerun resumes an interrupted download
+    download_folder = Path(os.path.join(base_output_folder, 'downloads'))
+    os.makedirs(download_folder, exist_ok=True)
+    filepath_zip = Path(os.path.join(download_folder, f"{date_encoding}.zip"))
 
+    manifest = Manifest()
+    members = None
+    source = {}
+    conversions = []
+    outputs = []
     for file in files:
         # Skip if the action_type does not match the file naming
         if action_type == "leases" and "Transactions" in file:
             continue
         if action_type == "transactions" and "Rents" in file:
             continue
-        dataset_file = Path(os.path.join(*[base_output_folder, date_encoding, f"{file}_{date_encoding}.csv"]))
+        entry = manifest.get(action_type, file, date_encoding)
+        # A quarter done without the unfiltered partition is converted again when it is requested
+        needs_unfiltered = keep_unfiltered and not entry.get('unfiltered')
+        if entry.get('status') == 'missing' or (entry.get('uploaded') and not needs_unfiltered):
+            print(f"{file}_{date_encoding} is already done according to the manifest.")
+            continue
+        if entry.get('status') in ['converted', 'uploaded'] and needs_unfiltered:
+            print(f"{file}_{date_encoding} has no unfiltered partition yet, converting it again.")
+
+        dataset_file = f"{file}_{date_encoding}.csv"
+        # The parquet files go to the hive partitioned dataset (file=/year=/quarter=), the CSV files stay flat
         output_folder = Path(os.path.join(base_output_folder, f"{file}"))
-        dataset_file_parquet = Path(os.path.join(output_folder, f"{file}_{date_encoding}.parquet"))
+        dataset_file_parquet = partition_path(base_output_folder, file, date_encoding)
         dataset_file_csv = Path(os.path.join(output_folder, f"{file}_{date_encoding}.csv"))
-        os.makedirs(output_folder, exist_ok=True)
-        if os.path.exists(dataset_file_parquet):
+        dataset_file_unfiltered = None
+        if keep_unfiltered:
+            dataset_file_unfiltered = partition_path(base_output_folder, f"{file}_unfiltered", date_encoding)
+        if entry.get('status') == 'converted' and not needs_unfiltered:
             print(f"{dataset_file_parquet} was already generated.")
         else:
-            # Get the archive/folder in order to generate the parquet file
-            if not os.path.exists(folder_extracted_zip):
+            # Get the archive in order to generate the parquet file
+            if members is None:
+                remote = remote_metadata(dataset_url)
+                # The checksum of an earlier download is only known-good if the remote file did not change since
+                expected_sha256 = entry.get('source_sha256') if remote['etag'] and entry.get('source_etag') == remote['etag'] else None
+                if os.path.exists(filepath_zip):
+                    source = {'sha256': sha256sum(filepath_zip), 'etag': remote['etag']}
+                    if (remote['size'] is not None and os.path.getsize(filepath_zip) != remote['size']) or \
+                            (expected_sha256 is not None and source['sha256'] != expected_sha256):
+                        print(f"{filepath_zip} does not match {dataset_url}, downloading it again.")
+                        os.remove(filepath_zip)
                 if not os.path.exists(filepath_zip):
-                    download_url(dataset_url, filepath_zip)
-
-                extract_zip(filepath_zip, folder_extracted_zip)
-                # Clean storage (remove downloaded ZIP file)
-                os.remove(filepath_zip)
+                    source = download_url(dataset_url, filepath_zip, expected_size=remote['size'],
+                                          expected_sha256=expected_sha256)
+                members = zip_members(filepath_zip)
 
-            #df = fetch(dataset_file)
-            #df = pd.read_csv(dataset_file,sep=';')
-
-            if not os.path.exists(dataset_file):
+            if dataset_file not in members:
                 # Not all datasets have the same atomic representation files
-                print(f'Dataset file {dataset_file} does not exist in this folder.')
+                print(f'Dataset file {dataset_file} does not exist in this archive.')
+                manifest.update(action_type, file, date_encoding, status='missing',
+                                source_etag=source['etag'], source_sha256=source['sha256'])
                 continue
 
-            if not os.path.exists(dataset_file_csv):
-                # Load the large raw CSV file, remove the NAN rows and save the result as CSV
-                load_raw_clean_save(load_from = dataset_file, save_to = dataset_file_csv, chunksize=10000)
-
-            #df = clean(df)
+            os.makedirs(output_folder, exist_ok=True)
+            os.makedirs(dataset_file_parquet.parent, exist_ok=True)
+            if dataset_file_unfiltered is not None:
+                os.makedirs(dataset_file_unfiltered.parent, exist_ok=True)
 
-            if not os.path.exists(dataset_file_parquet):
-                # Read the CSV file without NAN rows
-                df = fetch(dataset_file_csv)
+            # Stream the large raw CSV file out of the archive, remove the NAN rows, filter them by the spec of the dataset
+            # family and write both the parquet and the CSV file.
+            # The members of one archive are converted concurrently.
+            conversions.append((file, dataset_file_parquet, dataset_file_csv, dataset_file_unfiltered,
+                                convert_csv_to_parquet.submit(load_from=members[dataset_file], save_to=dataset_file_parquet,
+                                                              save_csv_to=dataset_file_csv, chunksize=10000, zip_path=filepath_zip,
+                                                              save_unfiltered_to=dataset_file_unfiltered)))
+        outputs.append((file, dataset_file_parquet, dataset_file_csv, dataset_file_unfiltered))
 
-                # Clean storage (remove CSV file without NANs; parquet will be saved instead)
-                #os.remove(dataset_file_csv)
-
-                # Write the parquet file
-
-                path = write_local(df, dataset_file_parquet)
+    index = PartitionIndex(base_output_folder)
+    for file, dataset_file_parquet, dataset_file_csv, dataset_file_unfiltered, conversion in conversions:
+        rows = conversion.result()
+        index.add(file, date_encoding, dataset_file_parquet, rows)
+        if dataset_file_unfiltered is not None:
+            index.add(f"{file}_unfiltered", date_encoding, dataset_file_unfiltered,
+                      pq.ParquetFile(dataset_file_unfiltered).metadata.num_rows)
+        manifest.update(action_type, file, date_encoding, status='converted', rows=rows,
+                        source_etag=source['etag'], source_sha256=source['sha256'],
+                        parquet_sha256=sha256sum(dataset_file_parquet), csv_sha256=sha256sum(dataset_file_csv))
 
+    for file, dataset_file_parquet, dataset_file_csv, dataset_file_unfiltered in outputs:
         write_gcs(dataset_file_parquet)
         write_gcs(dataset_file_csv)
-    
-    if os.path.exists(folder_extracted_zip):
-        # Clean storage (remove folder of the extracted ZIP)
-        shutil.rmtree(folder_extracted_zip)
+        unfiltered = dataset_file_unfiltered is not None and os.path.exists(dataset_file_unfiltered)
+        if unfiltered:
+            write_gcs(dataset_file_unfiltered)
+        manifest.update(action_type, file, date_encoding, status='uploaded', uploaded=1, unfiltered=int(unfiltered))
+    if conversions:
+        # The partition index goes along, so etl_gcs_to_bq reads the bucket without listing it
+        write_gcs_index(index, action_type)
+
+    if os.path.exists(filepath_zip):
+        # Clean storage (remove downloaded ZIP file)
+        os.remove(filepath_zip)
 
 @flow(log_prints=True)
-def etl_web_to_gcs_main(action_types = None, files = None, years = None, months = None) -> None:
-    for action_type in action_types:
-        for year in years:
-            for month in months:
-                etl_web_to_gcs(action_type, files, year, month)
+def etl_web_to_gcs_main(action_types = None, files = None, years = None, months = None,
+                        max_workers: int = 1, max_downloads: int = 2, max_conversions: int = 2, max_uploads: int = 4,
+                        keep_unfiltered: bool = False) -> None:
+    '''Run etl_web_to_gcs for every quarter; with max_workers > 1 the quarters run in parallel'''
+    STAGE_LIMITS.configure(max_downloads, max_conversions, max_uploads)
+    quarters = [(action_type, year, month) for action_type in action_types for year in years for month in months]
+
+    if max_workers <= 1:
+        for action_type, year, month in quarters:
+            etl_web_to_gcs(action_type, files, year, month, keep_unfiltered)
+        return
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Run every quarter in a copy of this flow's context, so it is tracked as a subflow of this run
+        futures = {executor.submit(contextvars.copy_context().run, etl_web_to_gcs, action_type, files, year, month, keep_unfiltered): (action_type, year, month)
+                   for action_type, year, month in quarters}
+        for future in as_completed(futures):
+            action_type, year, month = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Quarter {year}-{month:02} of {action_type} failed: {e}")
+                failed.append((action_type, year, month))
+    if failed:
+        raise RuntimeError(f"{len(failed)} quarter(s) failed: {failed}")
 
 if __name__ == "__main__":
     action_types = ["transactions", "leases"]
@@ -215,4 +367,5 @@ if __name__ == "__main__":
     # name formatting for sales 89209670-51ca-11eb-beeb-3448ed25ad7c_YYYYMMDD_csv_NA_01000
     # name formatting for leases 84d5f470-51ca-11eb-8a67-3448ed25ad7c_YYYYMMDD_csv_NA_01000.zip
     # download link example https://opendata.fin.belgium.be/download/datasets/89209670-51ca-11eb-beeb-3448ed25ad7c_20160331_csv_NA_01000.zip
-    etl_web_to_gcs_main(action_types=action_types, files=files, years=years, months=months)
+    etl_web_to_gcs_main(action_types=action_types, files=files, years=years, months=months,
+                        max_workers=4, max_downloads=2, max_conversions=2, max_uploads=4)
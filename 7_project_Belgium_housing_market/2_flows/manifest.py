@@ -0,0 +1,70 @@
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'manifest.sqlite')
+
+# Per (action_type, file, date_encoding): where the data came from, what was produced from it
+# and how far it went down the pipeline. status is 'missing', 'converted' or 'uploaded'.
+# fingerprint is the content hash of the source rows a derived table was last computed from.
+# unfiltered tells whether the <file>_unfiltered partition (keep_unfiltered) went along.
+COLUMNS = {'status':         'TEXT',
+           'source_etag':    'TEXT',
+           'source_sha256':  'TEXT',
+           'rows':           'INTEGER',
+           'parquet_sha256': 'TEXT',
+           'csv_sha256':     'TEXT',
+           'uploaded':       'INTEGER DEFAULT 0',
+           'bq_loaded':      'INTEGER DEFAULT 0',
+           'unfiltered':     'INTEGER DEFAULT 0',
+           'fingerprint':    'TEXT',
+           'updated_at':     'TEXT'}
+
+class Manifest:
+    '''Local state store that lets reruns of the flows skip the work that is already done'''
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        columns = ', '.join(f"{name} {sql_type}" for name, sql_type in COLUMNS.items())
+        with self._connect() as con, con:
+            con.execute(f"CREATE TABLE IF NOT EXISTS manifest (action_type TEXT, file TEXT, date_encoding TEXT, {columns}, "
+                        "PRIMARY KEY (action_type, file, date_encoding))")
+            # Add the columns that were introduced after the store was created
+            existing = {row['name'] for row in con.execute("PRAGMA table_info(manifest)")}
+            for name, sql_type in COLUMNS.items():
+                if name not in existing:
+                    con.execute(f"ALTER TABLE manifest ADD COLUMN {name} {sql_type}")
+
+    def _connect(self):
+        # A short-lived connection per call, so the store can be used from parallel task threads
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        return closing(con)
+
+    def get(self, action_type: str, file: str, date_encoding: str) -> dict:
+        '''Manifest entry of a file and quarter, or an empty dict if there is none'''
+        with self._connect() as con:
+            row = con.execute("SELECT * FROM manifest WHERE action_type = ? AND file = ? AND date_encoding = ?",
+                              (action_type, file, date_encoding)).fetchone()
+        return dict(row) if row is not None else {}
+
+    def entries(self, action_type: str, file: str) -> dict:
+        '''All manifest entries of a file, by date_encoding'''
+        with self._connect() as con:
+            rows = con.execute("SELECT * FROM manifest WHERE action_type = ? AND file = ?", (action_type, file)).fetchall()
+        return {row['date_encoding']: dict(row) for row in rows}
+
+    def update(self, action_type: str, file: str, date_encoding: str, **fields) -> None:
+        '''Create or update the manifest entry of a file and quarter with the given fields'''
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown manifest fields: {sorted(unknown)}")
+        fields['updated_at'] = datetime.now(timezone.utc).isoformat()
+        names = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        assignments = ', '.join(f"{name} = excluded.{name}" for name in fields)
+        with self._connect() as con, con:
+            con.execute(f"INSERT INTO manifest (action_type, file, date_encoding, {names}) VALUES (?, ?, ?, {placeholders}) "
+                        f"ON CONFLICT (action_type, file, date_encoding) DO UPDATE SET {assignments}",
+                        (action_type, file, date_encoding, *fields.values()))
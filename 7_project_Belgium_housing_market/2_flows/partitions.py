@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+
+# Hive layout of a dataset root (data/<action_type>): file=<File>/year=<YYYY>/quarter=<Q>/<File>_<YYYYMMDD>.parquet
+PARTITIONING = ds.partitioning(pa.schema([('file', pa.string()), ('year', pa.int32()), ('quarter', pa.int32())]),
+                               flavor='hive')
+INDEX_FILE = '_partitions.json'
+
+_index_lock = threading.Lock()
+
+def quarter_of(date_encoding: str) -> tuple:
+    '''(year, quarter) of a YYYYMMDD quarter end date'''
+    return int(date_encoding[0:4]), (int(date_encoding[4:6]) - 1) // 3 + 1
+
+def quarter_end(year: int, quarter: int) -> str:
+    '''YYYYMMDD end date of a quarter, as used in the dataset file names'''
+    month = quarter * 3
+    day = 31 if month in [3, 12] else 30
+    return f"{year}{month:02}{day}"
+
+def partition_dir(file: str, date_encoding: str) -> str:
+    '''Relative folder of the partition of a file and quarter'''
+    year, quarter = quarter_of(date_encoding)
+    return os.path.join(f"file={file}", f"year={year}", f"quarter={quarter}")
+
+def partition_path(root, file: str, date_encoding: str) -> Path:
+    '''Parquet file of a file and quarter under a dataset root'''
+    return Path(os.path.join(root, partition_dir(file, date_encoding), f"{file}_{date_encoding}.parquet"))
+
+def gcs_filesystem(gcp_credentials_block) -> fs.GcsFileSystem:
+    '''PyArrow filesystem of GCS with the service account of a Prefect GcpCredentials block'''
+    from google.auth.transport.requests import Request
+    credentials = gcp_credentials_block.get_credentials_from_service_account()
+    credentials.refresh(Request())
+    # The token is valid for an hour, longer than a flow run reads
+    return fs.GcsFileSystem(access_token=credentials.token,
+                            credential_token_expiration=credentials.expiry.replace(tzinfo=timezone.utc))
+
+class PartitionIndex:
+    '''Lightweight JSON index of the partitions written under a dataset root, so readers need no listing.
+
+    The root is a local folder, or a "<bucket>/<action_type>" path of a PyArrow filesystem such as GCS.
+    '''
+    def __init__(self, root, filesystem: fs.FileSystem = None):
+        self.root = f"{root}"
+        self.filesystem = filesystem
+        self.path = os.path.join(self.root, INDEX_FILE)
+
+    def _load(self) -> dict:
+        if self.filesystem is not None:
+            if self.filesystem.get_file_info(self.path).type == fs.FileType.NotFound:
+                return {}
+            with self.filesystem.open_input_stream(self.path) as stream:
+                return json.loads(stream.read())
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as fd:
+            return json.load(fd)
+
+    def add(self, file: str, date_encoding: str, path, rows: int) -> None:
+        '''Record (or replace) the partition of a file and quarter'''
+        year, quarter = quarter_of(date_encoding)
+        with _index_lock:
+            index = self._load()
+            index[f"{file}/{date_encoding}"] = {'file': file, 'year': year, 'quarter': quarter,
+                                                'date': date_encoding, 'rows': rows,
+                                                'path': os.path.relpath(path, self.root)}
+            self._save(index)
+
+    def merge(self, other: 'PartitionIndex') -> None:
+        '''Add (or replace) the entries of another index in this one, e.g. those of a local run in the index in GCS.
+
+        The local index of a run only has the partitions converted on that machine; merging it keeps
+        the partitions that other runs (machines, CI jobs) recorded in the shared index.
+        '''
+        with _index_lock:
+            index = self._load()
+            index.update(other._load())
+            self._save(index)
+
+    def _save(self, index: dict) -> None:
+        if self.filesystem is not None:
+            self.filesystem.create_dir(self.root, recursive=True)
+            # An object store replaces the object in one write
+            with self.filesystem.open_output_stream(self.path) as stream:
+                stream.write(json.dumps(index, indent=1, sort_keys=True).encode())
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{self.path}.part", 'w') as fd:
+            json.dump(index, fd, indent=1, sort_keys=True)
+        os.replace(f"{self.path}.part", self.path)
+
+    def partitions(self, files: list[str] = None, years: list[int] = None, quarters: list[int] = None,
+                   dates: list[str] = None) -> list[dict]:
+        '''Index entries of the requested files, years, quarters and YYYYMMDD dates (None selects all), in date order'''
+        entries = [entry for entry in self._load().values()
+                   if (files is None or entry['file'] in files)
+                   and (years is None or entry['year'] in years)
+                   and (quarters is None or entry['quarter'] in quarters)
+                   and (dates is None or entry['date'] in dates)]
+        return sorted(entries, key=lambda entry: (entry['file'], entry['date']))
+
+    def paths(self, **selection) -> list[str]:
+        '''Absolute paths of the selected partitions'''
+        return [os.path.join(self.root, entry['path']) for entry in self.partitions(**selection)]
+
+def with_date(table: pa.Table) -> pa.Table:
+    '''Add the quarter end Date derived from the year and quarter partition columns'''
+    dates = [datetime.strptime(quarter_end(year, quarter), "%Y%m%d")
+             for year, quarter in zip(table['year'].to_pylist(), table['quarter'].to_pylist())]
+    return table.append_column('Date', pa.array(dates, pa.timestamp('us')))
+
+def partitions_dataset(root, filesystem: fs.FileSystem = None, **selection) -> ds.Dataset:
+    '''PyArrow dataset of the partitions selected in the index of a dataset root, None if there are none'''
+    paths = PartitionIndex(root, filesystem).paths(**selection)
+    if not paths:
+        return None
+    return ds.dataset(paths, format='parquet', filesystem=filesystem, partitioning=PARTITIONING,
+                      partition_base_dir=f"{root}")
+
+def read_partitions(root, files: list[str] = None, years: list[int] = None, quarters: list[int] = None,
+                    dates: list[str] = None, columns: list[str] = None, filters: pc.Expression = None,
+                    filesystem: fs.FileSystem = None) -> pa.Table:
+    '''Read a range of partitions of a dataset root in one PyArrow dataset scan.
+
+    Only the partitions selected in the index are opened. The selected columns that the files do not
+    have are skipped. The partition columns file, year and quarter and the derived Date are added to
+    them; use .to_pandas() for pandas.
+    '''
+    dataset = partitions_dataset(root, filesystem, files=files, years=years, quarters=quarters, dates=dates)
+    if dataset is None:
+        return pa.table({})
+    if columns is not None:
+        columns = [col for col in columns if col in dataset.schema.names and col not in PARTITIONING.schema.names]
+        columns += PARTITIONING.schema.names
+    return with_date(dataset.to_table(columns=columns, filter=filters))
+
+def spark_read_partitions(spark, root, files: list[str] = None, years: list[int] = None, quarters: list[int] = None,
+                          dates: list[str] = None):
+    '''Spark DataFrame of a range of partitions of a dataset root, with the file, year and quarter columns'''
+    paths = PartitionIndex(root).paths(files=files, years=years, quarters=quarters, dates=dates)
+    if not paths:
+        raise FileNotFoundError(f"No partitions of {files} for {dates or 'all dates'} in the index of {root}")
+    return spark.read.option("basePath", f"{root}").parquet(*paths)
@@ -0,0 +1,90 @@
+import numpy as np
+import pyarrow as pa
+
+# Declared columns of the opendata.fin.belgium.be CSV files, per dataset family.
+# Low-cardinality text columns are categoricals and the measures are downcast to float32.
+TRANSACTIONS_DTYPES = {
+    'NISCode':          str,
+    'Fictious':         str,
+    'NameFre':          str,
+    'NameDut':          str,
+    'NameGer':          str,
+    'TransactionType':  'category',
+    'ParcelNature':     'category',
+    'ParcelsNumber':    np.float32,
+    'PriceP25':         np.float32,
+    'PriceP50':         np.float32,
+    'PriceP75':         np.float32,
+    'ParcelsAreaP25':   np.float32,
+    'ParcelsAreaP50':   np.float32,
+    'ParcelsAreaP75':   np.float32}
+
+RENTS_DTYPES = {
+    'NISCode':          str,
+    'NameFre':          str,
+    'NameDut':          str,
+    'NameGer':          str,
+    'RegistrationType': 'category',
+    'LessorType':       'category',
+    'TakerType':        'category',
+    'RentsNumber':      np.float32,
+    'RentP25':          np.float32,
+    'RentP50':          np.float32,
+    'RentP75':          np.float32,
+    'ChargesP25':       np.float32,
+    'ChargesP50':       np.float32,
+    'ChargesP75':       np.float32,
+    'TotalRentP25':     np.float32,
+    'TotalRentP50':     np.float32,
+    'TotalRentP75':     np.float32}
+
+SCHEMAS = {'Transactions': TRANSACTIONS_DTYPES,
+           'Rents': RENTS_DTYPES}
+
+ARROW_TYPES = {str: pa.string(),
+               'category': pa.dictionary(pa.int32(), pa.string()),
+               np.float32: pa.float32()}
+
+def dataset_family(file) -> str:
+    '''Dataset family (Transactions or Rents) of a file name or path'''
+    return 'Rents' if 'Rents' in f"{file}" else 'Transactions'
+
+def pandas_dtypes(family: str, columns: list[str] = None) -> dict:
+    '''pandas dtypes of a dataset family, restricted to the given columns'''
+    dtypes = SCHEMAS[family]
+    if columns is None:
+        return dict(dtypes)
+    return {col: dtypes[col] for col in columns if col in dtypes}
+
+def arrow_schema(family: str, columns: list[str]) -> pa.Schema:
+    '''Arrow schema of a dataset family, for the declared columns present in a file, in file order'''
+    return pa.schema([pa.field(col, ARROW_TYPES[dtype]) for col, dtype in pandas_dtypes(family, columns).items()])
+
+# What the pipeline keeps of the raw CSV files, per dataset family: the rows whose columns hold one
+# of the listed values, and optionally only some of the declared columns (None keeps all of them).
+FILTER_SPECS = {
+    'Transactions': {'rows': {'ParcelNature': ['200'],             # Maison/house
+                              'TransactionType': ['VENTEIMMEUB']},  # Private direct sales
+                     'columns': None},
+    'Rents': {'rows': {},
+              'columns': None}}
+
+def filter_spec(family: str) -> dict:
+    '''Filter/projection spec of a dataset family'''
+    return FILTER_SPECS[family]
+
+def projected_columns(spec: dict, columns: list[str]) -> list[str]:
+    '''The given columns that a filter spec keeps, in the given order'''
+    if spec.get('columns') is None:
+        return list(columns)
+    return [col for col in columns if col in spec['columns']]
+
+def apply_filter_spec(df, spec: dict):
+    '''Rows and columns of a DataFrame that a filter spec keeps'''
+    for col, values in spec.get('rows', {}).items():
+        df = df[df[col].isin(values)]
+    return df[projected_columns(spec, df.columns)]
+
+def arrow_filters(spec: dict) -> list:
+    '''Row filters of a spec in the form of pyarrow.parquet.read_table, or None without filters'''
+    return [(col, 'in', values) for col, values in spec.get('rows', {}).items()] or None
@@ -0,0 +1,55 @@
+import math
+import os
+import threading
+
+from pyspark.sql import SparkSession
+
+APP_NAME = "belgian_housing_buy_lease"
+BYTES_PER_SHUFFLE_PARTITION = 64 * 2**20  # 64 MB
+MAX_SHUFFLE_PARTITIONS = 2000
+
+def shuffle_partitions_for(input_bytes: int, bytes_per_partition: int = BYTES_PER_SHUFFLE_PARTITION) -> int:
+    '''Number of shuffle partitions for a job reading input_bytes of parquet, at least one per core'''
+    needed = math.ceil(input_bytes / bytes_per_partition)
+    return min(MAX_SHUFFLE_PARTITIONS, max(os.cpu_count() or 1, needed))
+
+class SparkSessionManager:
+    '''Creates one tuned SparkSession per flow run and shares it between the tasks of that run'''
+    def __init__(self, app_name: str = APP_NAME):
+        self.app_name = app_name
+        self._session = None
+        self._lock = threading.Lock()
+
+    def start(self, spark_master: str = "local[*]", input_bytes: int = 0) -> SparkSession:
+        '''Create the session (or retune the running one) for a job reading input_bytes'''
+        shuffle_partitions = shuffle_partitions_for(input_bytes)
+        with self._lock:
+            if self._session is None:
+                self._session = SparkSession.builder \
+                    .master(spark_master or "local[*]") \
+                    .appName(self.app_name) \
+                    .config("spark.sql.adaptive.enabled", "true") \
+                    .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+                    .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+                    .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+                    .config("spark.sql.parquet.outputTimestampType", "TIMESTAMP_MICROS") \
+                    .config("spark.sql.shuffle.partitions", shuffle_partitions) \
+                    .getOrCreate()
+            else:
+                self._session.conf.set("spark.sql.shuffle.partitions", shuffle_partitions)
+            print(f"Spark session {self.app_name} on {spark_master} with {shuffle_partitions} shuffle partitions")
+            return self._session
+
+    def session(self) -> SparkSession:
+        '''The running session, started with the default settings if there is none yet'''
+        if self._session is None:
+            return self.start()
+        return self._session
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.stop()
+                self._session = None
+
+SPARK = SparkSessionManager()
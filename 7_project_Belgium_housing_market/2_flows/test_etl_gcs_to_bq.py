@@ -0,0 +1,33 @@
+'''The quarters uploaded before the hive partitioned layout load from their CSV, not their parquet file.
+
+Runs on the artifacts committed in data/: python -m pytest 7_project_Belgium_housing_market/2_flows
+'''
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from etl_gcs_to_bq import LOCAL_PATH, read_legacy_csv
+from schemas import arrow_schema, filter_spec
+
+FILE = 'ArrondissementWideRealEstateTransactions'
+LEGACY = os.path.join(LOCAL_PATH, 'data', FILE, f"{FILE}_20160331")
+
+def test_legacy_parquet_is_untyped():
+    # Read with sep=';' from a comma separated file: one text column holding whole lines
+    schema = pq.read_schema(f"{LEGACY}.parquet")
+    assert len(schema.names) == 1
+    assert 'ParcelNature' not in schema.names
+
+def test_read_legacy_csv():
+    table = read_legacy_csv(f"{LEGACY}.csv", FILE)
+    assert table.schema.equals(arrow_schema('Transactions', table.column_names))
+    assert 'ParcelNature' in table.column_names
+    # The rows the baseline flow loaded from the same CSV
+    df = pd.read_csv(f"{LEGACY}.csv", dtype=str)
+    for col, values in filter_spec('Transactions')['rows'].items():
+        df = df[df[col].isin(values)]
+        assert set(table[col].to_pylist()) <= set(values)
+    assert table.num_rows == len(df) > 0
+    assert table['PriceP50'].type == pa.float32()
@@ -0,0 +1,171 @@
+import glob
+import os
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+PROJECT_ID = "belgium-housing-market"
+LOCAL_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGING_PATH = os.path.join(LOCAL_PATH, 'data', 'staging')
+LOCAL_WAREHOUSE_PATH = os.path.join(LOCAL_PATH, 'data', 'warehouse')
+
+def write_parquet(table: pa.Table, path: Path) -> None:
+    '''Write an Arrow table with microsecond timestamps, which Spark can read (nanoseconds it cannot)'''
+    pq.write_table(table, path, coerce_timestamps='us', allow_truncated_timestamps=True)
+
+def date_strings(table: pa.Table) -> pa.Array:
+    '''The Date column of a table as YYYY-MM-DD strings'''
+    return pc.strftime(table['Date'], format='%Y-%m-%d')
+
+def concat_tables(tables: list[pa.Table]) -> pa.Table:
+    '''Concatenate tables of one file written with different schemas over time.
+
+    Dictionary columns are decoded, missing columns are filled with nulls and numeric types are
+    widened (e.g. float32 and float64 artifacts of the same column).
+    '''
+    decoded = []
+    for table in tables:
+        fields = [pa.field(field.name, field.type.value_type, field.nullable) if pa.types.is_dictionary(field.type) else field
+                  for field in table.schema]
+        decoded.append(table.cast(pa.schema(fields, table.schema.metadata)))
+    return pa.concat_tables(decoded, promote_options="permissive")
+
+def parquet_files(path: Path) -> list[str]:
+    '''Parquet files of a single file path or of a directory written by Spark'''
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*.parquet')))
+    # Spark writes no partition folder at all for a level without rows
+    return [f"{path}"] if os.path.exists(path) else []
+
+class LocalBackend:
+    '''Warehouse stand-in where every table is a parquet file under a local folder (dataset/table.parquet)'''
+    def __init__(self, root: str = LOCAL_WAREHOUSE_PATH):
+        self.root = root
+
+    def table_path(self, table: str) -> str:
+        return os.path.join(self.root, *table.split('.')) + '.parquet'
+
+    def read_table(self, table: str, dates: list[str] = None) -> pa.Table:
+        data = pq.read_table(self.table_path(table))
+        if dates is not None:
+            data = data.filter(pc.is_in(date_strings(data), value_set=pa.array(dates)))
+        return data
+
+    def export_table(self, table: str, path: Path, dates: list[str] = None) -> Path:
+        '''Copy a table, or only the rows of the given dates, to a local parquet file'''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_parquet(self.read_table(table, dates), path)
+        return path
+
+    def date_fingerprints(self, table: str) -> dict:
+        '''Row count and content hash of every Date of a table'''
+        df = self.read_table(table).to_pandas()
+        hashes = pd.util.hash_pandas_object(df.drop(columns=['Date']), index=False)
+        grouped = hashes.groupby(df['Date'].dt.strftime('%Y-%m-%d'))
+        return {date: f"{len(group)}-{int(group.sum()) % 2**64}" for date, group in grouped}
+
+    def replace_dates(self, path: Path, table: str, dates: list[str]) -> int:
+        '''Replace the rows of the given dates in a table with local parquet file(s)'''
+        destination = self.table_path(table)
+        if not os.path.exists(destination):
+            return self.load_parquet(path, table, write_disposition="WRITE_TRUNCATE")
+        kept = pq.read_table(destination)
+        kept = kept.filter(pc.invert(pc.is_in(date_strings(kept), value_set=pa.array(dates))))
+        loaded = [pq.read_table(file) for file in parquet_files(path)]
+        # One write, so a failed load leaves the table as it was
+        write_parquet(concat_tables([kept] + loaded), destination)
+        return sum(table.num_rows for table in loaded)
+
+    def load_parquet(self, path: Path, table: str, write_disposition: str = "WRITE_TRUNCATE") -> int:
+        '''Load local parquet file(s) into a table and return the number of rows loaded'''
+        files = parquet_files(path)
+        if not files:
+            return 0
+        loaded = pa.concat_tables([pq.read_table(file) for file in files])
+        destination = self.table_path(table)
+        if write_disposition == "WRITE_APPEND" and os.path.exists(destination):
+            loaded = concat_tables([pq.read_table(destination), loaded])
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        write_parquet(loaded, destination)
+        return loaded.num_rows
+
+class BigQueryBackend:
+    '''BigQuery tables, read through the BigQuery Storage API as Arrow and written with parquet load jobs'''
+    def __init__(self, gcp_credentials_block, project: str = PROJECT_ID):
+        from google.cloud import bigquery
+        self.bigquery = bigquery
+        self.project = project
+        self.client = gcp_credentials_block.get_bigquery_client(project=project)
+
+    def dates_parameter(self, dates: list[str]):
+        return self.bigquery.QueryJobConfig(query_parameters=[self.bigquery.ArrayQueryParameter("dates", "STRING", dates)])
+
+    def read_table(self, table: str, dates: list[str] = None) -> pa.Table:
+        if dates is None:
+            rows = self.client.list_rows(f"{self.project}.{table}")
+        else:
+            query = f"SELECT * FROM `{self.project}.{table}` WHERE CAST(DATE(Date) AS STRING) IN UNNEST(@dates)"
+            rows = self.client.query(query, job_config=self.dates_parameter(dates)).result()
+        return rows.to_arrow(create_bqstorage_client=True)
+
+    def export_table(self, table: str, path: Path, dates: list[str] = None) -> Path:
+        '''Download a table, or only the rows of the given dates, to a local parquet file without going through pandas'''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_parquet(self.read_table(table, dates), path)
+        return path
+
+    def date_fingerprints(self, table: str) -> dict:
+        '''Row count and content hash of every Date of a table, computed in BigQuery'''
+        query = f"""SELECT CAST(DATE(Date) AS STRING) AS date,
+                           FORMAT('%d-%d', COUNT(*), BIT_XOR(FARM_FINGERPRINT(TO_JSON_STRING(t)))) AS fingerprint
+                    FROM `{self.project}.{table}` AS t
+                    GROUP BY date"""
+        return {row.date: row.fingerprint for row in self.client.query(query).result()}
+
+    def replace_dates(self, path: Path, table: str, dates: list[str]) -> int:
+        '''Replace the rows of the given dates in a table with local parquet file(s), in one atomic MERGE'''
+        from google.api_core.exceptions import NotFound
+        try:
+            self.client.get_table(f"{self.project}.{table}")
+        except NotFound:
+            return self.load_parquet(path, table, write_disposition="WRITE_TRUNCATE")
+        if not parquet_files(path):
+            query = f"DELETE FROM `{self.project}.{table}` WHERE CAST(DATE(Date) AS STRING) IN UNNEST(@dates)"
+            self.client.query(query, job_config=self.dates_parameter(dates)).result()
+            return 0
+        # The new rows are loaded into a staging table first, so a failed load leaves the table untouched
+        staging = f"{table}_staging"
+        rows = self.load_parquet(path, staging, write_disposition="WRITE_TRUNCATE")
+        try:
+            query = f"""MERGE `{self.project}.{table}` AS target
+                        USING `{self.project}.{staging}` AS source
+                        ON FALSE
+                        WHEN NOT MATCHED BY SOURCE AND CAST(DATE(target.Date) AS STRING) IN UNNEST(@dates) THEN DELETE
+                        WHEN NOT MATCHED THEN INSERT ROW"""
+            self.client.query(query, job_config=self.dates_parameter(dates)).result()
+        finally:
+            self.client.delete_table(f"{self.project}.{staging}", not_found_ok=True)
+        return rows
+
+    def load_parquet(self, path: Path, table: str, write_disposition: str = "WRITE_TRUNCATE") -> int:
+        '''Load local parquet file(s) into a table with load jobs and return the number of rows loaded'''
+        rows = 0
+        for file in parquet_files(path):
+            job_config = self.bigquery.LoadJobConfig(source_format=self.bigquery.SourceFormat.PARQUET,
+                                                     write_disposition=write_disposition)
+            with open(file, 'rb') as fd:
+                job = self.client.load_table_from_file(fd, f"{self.project}.{table}", job_config=job_config)
+            rows += job.result().output_rows
+            # Every file after the first one is appended to what the first one wrote
+            write_disposition = self.bigquery.WriteDisposition.WRITE_APPEND
+        return rows
+
+def get_backend(backend: str = "bigquery"):
+    '''Warehouse backend by name: "bigquery", or "local" for offline runs and tests'''
+    if backend == "local":
+        return LocalBackend()
+    from prefect_gcp import GcpCredentials
+    return BigQueryBackend(GcpCredentials.load("belgium-housing-gcp-cred"))